@@ -1,13 +1,30 @@
+import asyncio
+import gzip
+import io
+import itertools
+import json
 import os.path
 import pytest
 import profet
+import profet.cleaver
 import profet.command_line
 from profet import Fetcher
 from profet import alphafold
 from profet import pdb
+import profet.index
+import profet.session
+import profet.sifts
 from collections import defaultdict
-from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, redirect_stdout
+from types import SimpleNamespace
 import re
+import requests
+import shutil
+import subprocess
+import sys
+import urllib3
+import zlib
 
 ONLY_ALPHAFOLD = "F4HvG8"
 ONLY_PDB = "7U6Q"
@@ -39,6 +56,14 @@ def test_set_default_database():
     assert prot_fetcher.get_default_db() == "alphafold"
 
 
+def test_fetcher_shares_session():
+    prot_fetcher = Fetcher(timeout=5)
+    assert prot_fetcher.session.timeout == 5
+    assert prot_fetcher.pdb.session is prot_fetcher.session
+    assert prot_fetcher.alpha.session is prot_fetcher.session
+    assert prot_fetcher.Cleaver.session is prot_fetcher.session
+
+
 def test_check_db_not_none():
     prot_fetcher = Fetcher()
     assert prot_fetcher.check_db(ONLY_ALPHAFOLD) is not None
@@ -54,6 +79,37 @@ def test_check_structure_in_alphafold():
     assert af_db.check_structure(ONLY_ALPHAFOLD) is True
 
 
+def test_check_structure_in_alphafold_without_download():
+    class Session:
+        def __init__(self):
+            self.requests = []
+
+        def head(self, url, **kwargs):
+            self.requests.append(("HEAD", url))
+            return SimpleNamespace(status_code=200)
+
+        def get(self, url, **kwargs):
+            self.requests.append(("GET", url))
+            if url.endswith("/NOTANID"):
+                return SimpleNamespace(status_code=404)
+            return SimpleNamespace(
+                status_code=200,
+                json=lambda: [{"entryId": "AF-F4HVG8-F1", "pdbUrl": "url"}],
+                raise_for_status=lambda: None,
+            )
+
+    # Only the AlphaFold API is asked, once per id
+    session = Session()
+    af_db = alphafold.Alphafold_DB(session=session)
+    assert af_db.check_structure(ONLY_ALPHAFOLD) is True
+    assert af_db.make_url(ONLY_ALPHAFOLD, "pdb") == "url"
+    assert af_db.check_structure("NOTANID") is False
+    assert session.requests == [
+        ("GET", af_db.make_api_url(ONLY_ALPHAFOLD)),
+        ("GET", af_db.make_api_url("NOTANID")),
+    ]
+
+
 def test_id_available_alphafold():
     prot_fetcher = Fetcher()
     prot_fetcher.get_file(ONLY_ALPHAFOLD)
@@ -75,6 +131,264 @@ def test_fetcher_get_file(tmpdir, test_id):
     assert os.path.exists(filename)
 
 
+def test_fetcher_get_files(tmpdir):
+    fetcher = Fetcher()
+    fetcher.set_directory(str(tmpdir))
+    results, errors = fetcher.get_files(
+        [ONLY_PDB, ONLY_ALPHAFOLD], filesave=True, max_workers=2
+    )
+    assert len(errors) == 0
+    for filename, contents in results.values():
+        assert os.path.exists(filename)
+
+
+def test_fetcher_get_files_collects_errors(monkeypatch):
+    def get_file(uniprot_id, **kwargs):
+        if uniprot_id == "BAD":
+            raise RuntimeError("Structure BAD not available on any database")
+        return None, uniprot_id
+
+    fetcher = Fetcher()
+    monkeypatch.setattr(fetcher, "get_file", get_file)
+    results, errors = fetcher.get_files(["A", "BAD", "B", "A"], max_workers=4)
+    assert results == {"A": (None, "A"), "B": (None, "B")}
+    assert list(errors) == ["BAD"]
+    assert isinstance(errors["BAD"], RuntimeError)
+
+
+def test_fetcher_stream(tmpdir, monkeypatch):
+    def file_from_db(prot_id, compressed=False, **kwargs):
+        chunks = iter([b"6Z6U ", b"cif data"])
+        if compressed:
+            chunks = profet.cache.compress_chunks(chunks)
+        return prot_id, "cif", chunks
+
+    for codec in [None, "gzip"]:
+        fetcher = Fetcher(
+            save_directory=str(tmpdir.join(str(codec))), codec=codec
+        )
+        monkeypatch.setattr(fetcher, "file_from_db", file_from_db)
+        monkeypatch.setattr(fetcher, "check_db", lambda *args, **kw: ["pdb"])
+
+        # The download is written to the cache and a handle returned
+        filename, handle = fetcher.get_file("6Z6U", stream=True)
+        assert os.fspath(handle) == filename
+        assert (handle.size, handle.fileorigin) == (13, "pdb")
+        assert handle.read() == "6Z6U cif data"
+
+        # As it is for a file already in the cache
+        filename, handle = fetcher.get_file("6Z6U", stream=True)
+        assert (handle.size, handle.fileorigin) == (13, "pdb")
+
+
+def test_async_fetcher_no_requests_session(tmpdir):
+    pytest.importorskip("httpx")
+    from profet.aio import AsyncFetcher
+
+    # The backends only make a requests session if they need one
+    fetcher = AsyncFetcher(save_directory=tmpdir)
+    for backend in [fetcher.pdb, fetcher.alpha, fetcher.Cleaver]:
+        assert backend._session is None
+    assert isinstance(fetcher.pdb.session, profet.session.PooledSession)
+
+
+def test_async_fetcher_get_files(tmpdir):
+    httpx = pytest.importorskip("httpx")
+    from profet.aio import AsyncFetcher
+
+    paths = []
+
+    def handler(request):
+        paths.append(request.url.path)
+        if request.url.host == "search.rcsb.org":
+            # All the matching entries are asked for
+            options = json.loads(request.content)["request_options"]
+            assert options == {"return_all_hits": True}
+            return httpx.Response(204)
+        if request.url.path == "/api/prediction/F4HVG8":
+            url = "https://alphafold.ebi.ac.uk/files/AF-F4HVG8-F1-model_v4.cif"
+            return httpx.Response(
+                200, json=[{"entryId": "AF-F4HVG8-F1", "cifUrl": url}]
+            )
+        if "AF-F4HVG8" in request.url.path:
+            return httpx.Response(200, text="F4HVG8 data" * 100)
+        return httpx.Response(404)
+
+    async def get_files():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        async with AsyncFetcher(
+            save_directory=str(tmpdir), client=client
+        ) as fetcher:
+            return await fetcher.get_files(
+                [ONLY_ALPHAFOLD, "NOTANID"], filesave=True
+            )
+
+    results, errors = asyncio.run(get_files())
+    filename, contents = results[ONLY_ALPHAFOLD]
+    assert filename == os.path.join(tmpdir, "f4hvg8.cif")
+    assert contents.startswith("F4HVG8 data")
+    assert list(errors) == ["NOTANID"]
+
+    # The file URL is resolved from the AlphaFold API, not guessed
+    assert "/files/AF-F4HVG8-F1-model_v4.cif" in paths
+    assert not any("model_v3" in path for path in paths)
+
+
+def test_async_fetcher_signal_cache(tmpdir):
+    httpx = pytest.importorskip("httpx")
+    from profet.aio import AsyncFetcher
+
+    paths = []
+
+    def handler(request):
+        paths.append(request.url.path)
+        return httpx.Response(200, content=b"<uniprot/>")
+
+    async def requester(uniprot_ids):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        async with AsyncFetcher(
+            save_directory=str(tmpdir), client=client
+        ) as fetcher:
+            return [
+                await fetcher.signal_residuenumbers_requester(uniprot_id)
+                for uniprot_id in uniprot_ids
+            ]
+
+    # The signal peptides are shared with the Fetcher
+    profet.cache.SignalPeptideCache(directory=tmpdir)["P01308"] = [(1, 24)]
+    assert asyncio.run(requester(["P01308", "P69905"])) == [[(1, 24)], []]
+    assert asyncio.run(requester(["P69905"])) == [[]]
+    assert len(paths) == 1
+
+
+def test_negative_cache(tmpdir):
+    negative_cache = profet.cache.NegativeCache(directory=tmpdir, ttl=60)
+    assert negative_cache.missing("2J3K") == []
+    negative_cache.add("2j3k", ["pdb", "alphafold"])
+    assert negative_cache.missing("2J3K") == ["pdb", "alphafold"]
+    negative_cache.remove("2J3K")
+    assert negative_cache.missing("2J3K") == []
+
+    negative_cache = profet.cache.NegativeCache(directory=tmpdir, ttl=-1)
+    negative_cache.add("2J3K", ["pdb"])
+    assert negative_cache.missing("2J3K") == []
+
+
+def test_check_db_uses_negative_cache(tmpdir, monkeypatch):
+    calls = []
+
+    def check_structure(uniprot_id):
+        calls.append(uniprot_id)
+        return False
+
+    fetcher = Fetcher(save_directory=str(tmpdir))
+    monkeypatch.setattr(fetcher.pdb, "check_structure", check_structure)
+    monkeypatch.setattr(fetcher.alpha, "check_structure", check_structure)
+    assert fetcher.check_db("NOTANID") == []
+    assert fetcher.check_db("NOTANID") == []
+    assert len(calls) == 2
+    assert fetcher.check_db("NOTANID", refresh=True) == []
+    assert len(calls) == 4
+
+
+def test_pdb_id_cache(tmpdir, monkeypatch):
+    id_cache = profet.cache.PDBIdCache(directory=tmpdir, ttl=60)
+    assert id_cache.get("P45523") is None
+    id_cache.update({"p45523": ["1Q6U", "1Q6H"], "NOTANID": []})
+    assert id_cache.get("P45523") == ["1Q6U", "1Q6H"]
+    assert id_cache.get("NOTANID") == []
+    assert "NOTANID" in id_cache
+
+    # The PDB is not searched for ids in the cache
+    monkeypatch.setattr(pdb.PDB_DB, "text_search", None)
+    pdb_db = pdb.PDB_DB(id_cache=id_cache)
+    assert pdb_db.uniprot_id_to_pdb_id("P45523") == "1Q6U"
+    assert pdb_db.check_structure("NOTANID") is False
+
+    id_cache = profet.cache.PDBIdCache(directory=tmpdir, ttl=-1)
+    assert id_cache.get("P45523") is None
+    id_cache.expire()
+    assert profet.cache.PDBIdCache(directory=tmpdir).get("P45523") is None
+
+
+def test_pdb_text_search():
+    class Session:
+        def __init__(self):
+            self.requests = []
+
+        def post(self, url, json=None, **kwargs):
+            self.requests.append((url, json))
+            result_set = [{"identifier": "1Q6U"}, {"identifier": "1Q6H"}]
+            return SimpleNamespace(
+                status_code=200,
+                json=lambda: {"result_set": result_set},
+                raise_for_status=lambda: None,
+            )
+
+    # The search goes through the session of the database
+    session = Session()
+    pdb_db = pdb.PDB_DB(session=session)
+    assert pdb_db.uniprot_id_to_pdb_ids("P45523") == ["1Q6U", "1Q6H"]
+    assert session.requests == [
+        (pdb_db.search_url, pdb_db.search_request("P45523"))
+    ]
+
+
+def test_sifts_index(tmpdir, monkeypatch):
+    tsv_filename = os.path.join(tmpdir, "pdb_chain_uniprot.tsv")
+    with open(tsv_filename, "w") as outfile:
+        outfile.write("# 2024/01/01 - 12:00 | PDB: 01.24 | UniProt: 2024.01\n")
+        outfile.write("PDB\tCHAIN\tSP_PRIMARY\tRES_BEG\tRES_END\n")
+        outfile.write("1q6u\tA\tP45523\t1\t200\n")
+        outfile.write("1q6u\tB\tP45523\t1\t200\n")
+        outfile.write("1q6h\tA\tP45523\t1\t200\n")
+        outfile.write("101m\tA\tP02185\t1\t154\n")
+
+    index = profet.sifts.SIFTSIndex.from_file(tsv_filename)
+    assert os.path.exists(tsv_filename + ".idx")
+    assert len(index) == 3
+    assert index.get("p45523") == ["1Q6H", "1Q6U"]
+    assert index.get("P02185") == ["101M"]
+    assert index.get("P00000") == []
+    assert "P02185" in index
+    index.close()
+
+    # The PDB is not searched when there is an index
+    monkeypatch.setattr(pdb.PDB_DB, "text_search", None)
+    index = profet.sifts.SIFTSIndex.from_file(tsv_filename + ".idx")
+    pdb_db = pdb.PDB_DB(sifts_index=index)
+    assert pdb_db.uniprot_id_to_pdb_id("P45523") == "1Q6H"
+    assert pdb_db.uniprot_id_to_pdb_id("4v5d") == "4V5D"
+    assert pdb_db.check_structure("P00000") is False
+
+
+def test_alphafold_index(tmpdir, monkeypatch):
+    csv_filename = os.path.join(tmpdir, "accession_ids.csv")
+    with open(csv_filename, "w") as outfile:
+        outfile.write("F4HVG8,1,340,AF-F4HVG8-F1,4\n")
+        outfile.write("Q8WZ42,1,1400,AF-Q8WZ42-F1,4\n")
+        outfile.write("Q8WZ42,201,1600,AF-Q8WZ42-F2,4\n")
+        outfile.write("A0A023FDY8,1,80,AF-A0A023FDY8-F1,3\n")
+
+    # Sort in small chunks to exercise the merge
+    monkeypatch.setattr(profet.index.AlphafoldIndex, "chunk_size", 2)
+    index = profet.index.AlphafoldIndex.from_file(csv_filename)
+    assert len(index) == 4
+    assert index.get("f4hvg8") == [(1, 4)]
+    assert index.get("Q8WZ42") == [(1, 4), (2, 4)]
+    assert index.latest_version("A0A023FDY8") == 3
+    assert index.latest_version("P00000") is None
+    assert "P00000" not in index
+
+    # The server is not probed when there is an index
+    af_db = alphafold.Alphafold_DB(session=None, accession_index=index)
+    monkeypatch.setattr(af_db, "session", None)
+    assert af_db.check_structure(ONLY_ALPHAFOLD) is True
+    assert af_db.check_structure("P00000") is False
+    assert af_db.make_url("A0A023FDY8", "cif").endswith("-F1-model_v3.cif")
+    assert af_db.make_url(ONLY_ALPHAFOLD, "cif").endswith("-F1-model_v4.cif")
+
+
 def test_cache(tmpdir):
     cache = profet.cache.PDBFileCache(directory=tmpdir)
 
@@ -122,6 +436,392 @@ def test_cache(tmpdir):
     assert os.path.join(tmpdir, "1u2p.pdb") in items["1u2p"]
 
 
+def test_cache_index(tmpdir):
+    cache = profet.cache.PDBFileCache(directory=tmpdir)
+    cache["4V5D"] = ("pdb", "cif", "4V5D cif data")
+    assert cache.get("4v5d", "cif") == os.path.join(tmpdir, "4v5d.cif")
+    assert cache.get("4v5d", "pdb") is None
+
+    # Files written by another process are found
+    with open(os.path.join(tmpdir, "6z6u.pdb"), "w") as outfile:
+        outfile.write("6Z6U pdb data")
+    assert cache.get("6Z6U") == os.path.join(tmpdir, "6z6u.pdb")
+
+    # Files removed by another process are forgotten on refresh
+    os.remove(os.path.join(tmpdir, "4v5d.cif"))
+    assert "4V5D" in cache
+    cache.refresh()
+    assert "4V5D" not in cache
+    assert "6Z6U" in profet.cache.PDBFileCache(directory=tmpdir)
+
+
+def test_cache_sharded_layout(tmpdir):
+    cache = profet.cache.PDBFileCache(directory=tmpdir)
+    cache["4V5D"] = ("pdb", "cif", "4V5D cif data")
+    cache["1U2P"] = ("alphafold", "pdb", "1U2P pdb data")
+    assert cache.layout == "flat"
+
+    # The layout of an existing cache can't be changed without migrating
+    with pytest.raises(RuntimeError):
+        profet.cache.PDBFileCache(directory=tmpdir, layout="sharded")
+
+    profet.command_line.main(
+        [
+            "cache",
+            "migrate",
+            "--layout",
+            "sharded",
+            "--save_directory",
+            str(tmpdir),
+        ]
+    )
+    cache = profet.cache.PDBFileCache(directory=tmpdir, layout="sharded")
+    filename = cache["4v5d"]
+    assert os.path.dirname(os.path.dirname(os.path.dirname(filename))) == tmpdir
+    assert not os.path.exists(os.path.join(tmpdir, "4v5d.cif"))
+    assert cache.query(identifier="4v5d")[0]["filename"] == filename
+    assert sorted(identifier for identifier, _ in cache.items()) == [
+        "1u2p",
+        "4v5d",
+    ]
+
+    cache["6Z6U"] = ("pdb", "cif", "6Z6U cif data")
+    cache.migrate("flat")
+    assert sorted(os.listdir(tmpdir)) == [
+        "1u2p.pdb",
+        "4v5d.cif",
+        "6z6u.cif",
+        "cache.sqlite",
+    ]
+
+
+def test_cache_compressed(tmpdir):
+    cache = profet.cache.PDBFileCache(directory=tmpdir)
+    cache["4V5D"] = ("pdb", "cif", "4V5D cif data")
+
+    cache = profet.cache.PDBFileCache(directory=tmpdir, codec="gzip")
+    cache["1U2P"] = ("pdb", "cif", "1U2P cif data")
+    cache["4V5D"] = ("pdb", "cif", "4V5D new cif data")
+    assert cache["1u2p"] == os.path.join(tmpdir, "1u2p.cif.gz")
+    assert cache["4v5d"] == os.path.join(tmpdir, "4v5d.cif.gz")
+    assert not os.path.exists(os.path.join(tmpdir, "4v5d.cif"))
+
+    # Compressed and uncompressed files are read the same way
+    cache["6Z6U"] = ("pdb", "pdb", b"6Z6U pdb data")
+    with open(os.path.join(tmpdir, "7u6q.pdb"), "w") as outfile:
+        outfile.write("7U6Q pdb data")
+    cache = profet.cache.PDBFileCache(directory=tmpdir)
+    with cache.open("1U2P") as infile:
+        assert infile.read() == "1U2P cif data"
+    with cache.open("6Z6U", mode="rb") as infile:
+        assert infile.read() == b"6Z6U pdb data"
+    with cache.open("7U6Q") as infile:
+        assert infile.read() == "7U6Q pdb data"
+    assert sorted(identifier for identifier, _ in cache.items()) == [
+        "1u2p",
+        "4v5d",
+        "6z6u",
+        "7u6q",
+    ]
+
+    entry = cache.query(identifier="4v5d")[0]
+    assert entry["codec"] == "gzip"
+    assert entry["size"] == len("4V5D new cif data")
+
+
+def test_cache_missing_codec(tmpdir, monkeypatch):
+    cache = profet.cache.PDBFileCache(directory=tmpdir, codec="zstd")
+    monkeypatch.setitem(sys.modules, "zstandard", None)
+
+    # The missing codec is reported rather than the missing temporary file
+    with pytest.raises(RuntimeError, match="zstandard"):
+        profet.cache.PDBFileCache(directory=tmpdir, codec="zstd")
+    with pytest.raises(RuntimeError, match="zstandard"):
+        cache["1U2P"] = ("pdb", "cif", "1U2P cif data")
+    assert os.listdir(tmpdir) == ["cache.sqlite"]
+
+
+def test_cache_compressed_download(tmpdir):
+    filedata = gzip.compress(b"1U2P cif data")
+
+    # Downloaded gzip files are written as they are
+    cache = profet.cache.PDBFileCache(directory=tmpdir, codec="gzip")
+    cache["1U2P"] = ("pdb", "cif", filedata, "gzip")
+    with open(cache["1U2P"], "rb") as infile:
+        assert infile.read() == filedata
+    assert cache.query(identifier="1u2p")[0]["size"] == len("1U2P cif data")
+
+    # Or decompressed if the cache is not compressed
+    cache = profet.cache.PDBFileCache(directory=tmpdir)
+    cache["6Z6U"] = ("pdb", "cif", filedata, "gzip")
+    with open(cache["6Z6U"], "rb") as infile:
+        assert infile.read() == b"1U2P cif data"
+
+
+@pytest.mark.parametrize("status", [404, 503])
+def test_alphafold_download_error(status):
+    class Session:
+        def get(self, url, **kwargs):
+            response = requests.Response()
+            response.status_code = status
+            response.url = url
+            response.raw = io.BytesIO(b"<html>Service Unavailable</html>" * 10)
+            return response
+
+    # An error page is not streamed as the file
+    af_db = alphafold.Alphafold_DB(session=Session())
+    if status == 404:
+        assert af_db.stream("url", min_size=200) is None
+    else:
+        with pytest.raises(requests.HTTPError):
+            af_db.stream("url", min_size=200)
+
+    # Nor downloaded as the file
+    for compressed in [False, True]:
+        with pytest.raises(requests.HTTPError):
+            af_db.download("url", compressed=compressed)
+
+
+@pytest.mark.parametrize(
+    "encoding, compress",
+    [("gzip", gzip.compress), ("deflate", zlib.compress), (None, bytes)],
+)
+def test_alphafold_compressed_download(encoding, compress):
+    filedata = b"F4HVG8 cif data"
+
+    class Session:
+        def get(self, url, headers=None, **kwargs):
+            assert headers == {"Accept-Encoding": "gzip"}
+            raw = urllib3.HTTPResponse(
+                body=io.BytesIO(compress(filedata)),
+                headers={"Content-Encoding": encoding} if encoding else {},
+                preload_content=False,
+            )
+            return SimpleNamespace(
+                headers=raw.headers,
+                raw=raw,
+                close=lambda: None,
+                raise_for_status=lambda: None,
+            )
+
+    # Whatever the transfer encoding, the file is returned gzip compressed
+    af_db = alphafold.Alphafold_DB(session=Session())
+    compressed = af_db.download("url", compressed=True)
+    assert gzip.decompress(compressed) == filedata
+
+
+def test_cache_manifest(tmpdir):
+    # A manifest from an older version is migrated
+    with open(os.path.join(tmpdir, "manifest.txt"), "w") as outfile:
+        json.dump(
+            {
+                "6Z6U": {
+                    "fileorigin": "pdb",
+                    "filetype": "cif",
+                    "filename": os.path.join(tmpdir, "6z6u.cif"),
+                }
+            },
+            outfile,
+        )
+    cache = profet.cache.PDBFileCache(directory=tmpdir)
+    assert not os.path.exists(os.path.join(tmpdir, "manifest.txt"))
+
+    with cache.batch():
+        cache["4V5D"] = ("pdb", "cif", "4V5D cif data")
+        cache["F4HVG8"] = ("alphafold", "pdb", "F4HVG8 pdb data")
+        cache["F4HVG8"] = ("alphafold", "cif", "F4HVG8 cif data")
+
+    assert len(cache.query()) == 4
+    assert len(cache.query(identifier="f4hvg8")) == 2
+    assert len(cache.query(fileorigin="pdb")) == 2
+    assert cache.query(fileorigin="alphafold", filetype="pdb") == [
+        {
+            "identifier": "f4hvg8",
+            "filetype": "pdb",
+            "fileorigin": "alphafold",
+            "filename": os.path.join(tmpdir, "f4hvg8.pdb"),
+            "codec": None,
+            "size": 15,
+        }
+    ]
+
+
+def test_cache_prune(tmpdir):
+    cache = profet.cache.PDBFileCache(directory=tmpdir, max_size=30)
+    for identifier in ["1U2P", "4V5D", "6Z6U"]:
+        cache[identifier] = ("pdb", "cif", identifier + " data")
+    assert cache.size() == 27
+
+    # The least recently used file is evicted to make room
+    cache.get("1U2P")
+    cache["7U6Q"] = ("pdb", "cif", "7U6Q data")
+    assert "4V5D" not in cache
+    assert not os.path.exists(os.path.join(tmpdir, "4v5d.cif"))
+    assert cache.size() == 27
+
+    # Or the least frequently used
+    profet.command_line.main(
+        [
+            "cache",
+            "prune",
+            "--max_size",
+            "15",
+            "--policy",
+            "lfu",
+            "--save_directory",
+            str(tmpdir),
+        ]
+    )
+    cache = profet.cache.PDBFileCache(directory=tmpdir)
+    assert [entry["identifier"] for entry in cache.query()] == ["1u2p"]
+    assert cache.size() == 9
+
+
+def test_cache_prune_lfu_keeps_new_item(tmpdir):
+    cache = profet.cache.PDBFileCache(
+        directory=tmpdir, max_size=30, policy="lfu"
+    )
+    for identifier in ["1U2P", "4V5D", "6Z6U"]:
+        cache[identifier] = ("pdb", "cif", identifier + " data")
+        cache.get(identifier)
+
+    # The item just written has the fewest hits but is not evicted
+    cache["7U6Q"] = ("pdb", "cif", "7U6Q data")
+    assert "7U6Q" in cache
+    assert cache["7U6Q"] == os.path.join(tmpdir, "7u6q.cif")
+    assert "1U2P" not in cache
+    assert cache.size() == 27
+
+
+def test_cache_get_does_not_write(tmpdir):
+    cache = profet.cache.PDBFileCache(directory=tmpdir)
+    cache["1U2P"] = ("pdb", "cif", "1U2P data")
+    bounded = profet.cache.PDBFileCache(directory=tmpdir, max_size=1000)
+
+    # Lookups don't wait for another process holding the write lock
+    connection = profet.cache.connect(os.path.join(tmpdir, "cache.sqlite"))
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        assert cache.get("1U2P") is not None
+        assert bounded.get("1U2P") is not None
+    finally:
+        connection.rollback()
+        connection.close()
+
+    # The accesses are recorded when the cache is pruned
+    bounded.prune()
+    assert [entry["identifier"] for entry in bounded.query()] == ["1u2p"]
+    with closing(profet.cache.connect(bounded.database)) as connection:
+        hits = connection.execute("SELECT hits FROM manifest").fetchone()[0]
+    assert hits == 1
+
+
+def test_cache_directory_recreated(tmpdir):
+    directory = os.path.join(tmpdir, "cache")
+    cache = profet.cache.PDBFileCache(directory=directory)
+    cache["1U2P"] = ("pdb", "cif", "1U2P cif data")
+
+    # The tables are created again in a new cache directory
+    shutil.rmtree(directory)
+    os.makedirs(directory)
+    cache = profet.cache.PDBFileCache(directory=directory)
+    cache["6Z6U"] = ("pdb", "cif", "6Z6U cif data")
+    assert [entry["identifier"] for entry in cache.query()] == ["6z6u"]
+
+
+def test_cache_accesses_through_fetcher(tmpdir):
+    fetcher = Fetcher(
+        save_directory=tmpdir, max_cache_size=10**6, cache_policy="lfu"
+    )
+    fetcher.cache()["F4HVG8"] = ("alphafold", "cif", "F4HVG8 " * 100)
+    fetcher.cache()["P12345"] = ("alphafold", "cif", "P12345 " * 100)
+
+    # Each lookup goes through a new cache object
+    for _ in range(3):
+        fetcher.get_file("F4HVG8", "cif")
+
+    # The most used item is kept
+    assert fetcher.cache().prune(max_size=1000) == [
+        fetcher.cache().path("P12345", "cif")
+    ]
+
+
+def test_cache_index_changed_by_other_process(tmpdir):
+    cache = profet.cache.PDBFileCache(directory=tmpdir)
+    cache["AAAA"] = ("pdb", "cif", "AAAA cif data")
+
+    # A file of the other type is found
+    with open(os.path.join(tmpdir, "aaaa.pdb"), "w") as outfile:
+        outfile.write("AAAA pdb data")
+    assert cache.get("AAAA", "pdb") == os.path.join(tmpdir, "aaaa.pdb")
+
+    # A removed file is forgotten once it fails to open
+    os.remove(os.path.join(tmpdir, "aaaa.cif"))
+    with pytest.raises(RuntimeError, match="not in cache"):
+        cache.open("AAAA", "cif")
+    assert cache.get("AAAA", "cif") is None
+    os.remove(os.path.join(tmpdir, "aaaa.pdb"))
+    assert cache.handle("AAAA", "pdb") is None
+    assert cache.get("AAAA") is None
+
+
+def test_fetcher_get_file_removed_from_cache(tmpdir):
+    fetcher = Fetcher(main_db="alphafold", save_directory=tmpdir)
+    fetcher.check_db = lambda uniprot_id, refresh=False: ["alphafold"]
+    fetcher.file_from_db = lambda prot_id, filetype, db, **kwargs: (
+        prot_id,
+        filetype,
+        "%s %s data" % (prot_id, filetype),
+    )
+    filename, _ = fetcher.get_file("F4HVG8", "cif", filesave=True)
+    os.remove(filename)
+
+    # The file is fetched again
+    result = fetcher.get_file("F4HVG8", "cif", filesave=True)
+    assert result == (filename, "F4HVG8 cif data")
+    assert os.path.exists(filename)
+
+
+def test_fetcher_get_file_cached_pdb(tmpdir):
+    fetcher = Fetcher(save_directory=tmpdir)
+    fetcher.cache()["P12345_1ABC"] = ("pdb", "cif", "1ABC cif data")
+    fetcher.check_db = lambda uniprot_id, refresh=False: pytest.fail()
+
+    # The structure cached under the uniprot and PDB ids is found
+    assert fetcher.get_file("P12345", "cif") == (
+        os.path.join(tmpdir, "p12345_1abc.cif"),
+        "1ABC cif data",
+    )
+
+
+def write_cache_items(directory, identifiers):
+    cache = profet.cache.PDBFileCache(directory=directory, codec="gzip")
+    for identifier in identifiers:
+        cache[identifier] = ("pdb", "cif", (identifier + " cif data") * 1000)
+        profet.cache.NegativeCache(directory=directory).add(identifier, ["pdb"])
+
+
+def test_cache_multiprocess(tmpdir):
+    # Processes writing to the same cache don't lose manifest entries
+    identifiers = ["%04d" % i for i in range(80)]
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(
+            executor.map(
+                write_cache_items,
+                [str(tmpdir)] * 4,
+                [identifiers[i::4] for i in range(4)],
+            )
+        )
+
+    cache = profet.cache.PDBFileCache(directory=tmpdir)
+    assert len(cache.query()) == len(identifiers)
+    assert sorted(name for name, _ in cache.items()) == identifiers
+    with cache.open("0042") as infile:
+        assert infile.read() == "0042 cif data" * 1000
+    negative_cache = profet.cache.NegativeCache(directory=tmpdir)
+    assert all(negative_cache.missing(i) == ["pdb"] for i in identifiers)
+
+
 def test_cache_download_cif_and_pdb(tmpdir):
     fetcher = profet.Fetcher()
     fetcher.set_directory(str(tmpdir))
@@ -158,6 +858,14 @@ def test_command_line_main(tmpdir, test_id):
         assert os.path.exists(filename)
 
 
+def test_command_line_render(tmpdir):
+    # Rendering the AlphaFold entry page is an option of the fetcher
+    args = profet.command_line.get_parser().parse_args(["F4HVG8", "--render"])
+    assert args.render
+    assert Fetcher(save_directory=tmpdir, render=args.render).alpha.render
+    assert not Fetcher(save_directory=tmpdir).alpha.render
+
+
 @pytest.mark.parametrize(
     "signal_peptides, hydrogens, water, hetatoms, expected_filename_suffix",
     [
@@ -207,3 +915,306 @@ def test_fetcher_remove_stuff(
 
     # Assert that the expected file exists
     assert os.path.exists(expected_filename)
+
+
+PDB_LINES = [
+    "HEADER    SYNTHETIC STRUCTURE\n",
+    "ATOM      1  N   ALA A   1      11.104   6.134  -6.504  1.00  0.00           N\n",
+    "ATOM      2  H   ALA A   2      11.639   6.071  -5.147  1.00  0.00           H\n",
+    "ATOM      3  CA  ALA A  30      12.200   7.100  -4.100  1.00  0.00           C\n",
+    "ATOM      4 HA2  GLY A  31      13.200   7.100  -4.100  1.00  0.00           H\n",
+    "HETATM    5  O   HOH A 101      10.000  10.000  10.000  1.00  0.00           O\n",
+    "HETATM    6 ZN    ZN A 102      10.000  10.000  10.000  1.00  0.00          ZN\n",
+    "ATOM      7  O   HOH A  -3       1.000   1.000   1.000  1.00  0.00           O\n",
+    "TER\n",
+    "END",
+]
+
+
+@pytest.mark.parametrize("flags", itertools.product([True, False], repeat=4))
+def test_cleaver_remove_nonmain_engines(tmpdir, flags):
+    input_file = os.path.join(tmpdir, "test.pdb")
+    with open(input_file, "w") as outfile:
+        outfile.write("".join(PDB_LINES))
+
+    # The vectorised engine writes exactly what the line by line one does
+    cleaver = profet.cleaver.Cleaver()
+    outputs = []
+    for engine in ["python", "numpy"]:
+        output_file = os.path.join(tmpdir, engine + ".pdb")
+        cleaver.remove_nonmain(
+            input_file,
+            [(1, 25)],
+            *flags,
+            output_filename=output_file,
+            engine=engine,
+        )
+        with open(output_file, "rb") as infile:
+            outputs.append(infile.read())
+    assert outputs[0] == outputs[1]
+
+
+CIF_TEXT = """data_TEST
+#
+_entry.id TEST
+#
+loop_
+_struct_asym.id
+_struct_asym.details
+A 'chain H2O'
+B "HETATM HOH"
+#
+loop_
+_atom_site.id
+_atom_site.label_seq_id
+_atom_site.group_PDB
+_atom_site.type_symbol
+_atom_site.label_atom_id
+_atom_site.label_comp_id
+1 1 ATOM N N ALA
+2 1 ATOM H H ALA
+3 30 ATOM C CA ALA
+4 31 ATOM C "C5'" GLY
+5 . HETATM O O HOH
+6 . HETATM ZN ZN ZN
+#
+"""
+
+
+def test_cleaver_remove_nonmain_cif(tmpdir):
+    input_file = os.path.join(tmpdir, "test.cif")
+    with open(input_file, "w") as outfile:
+        outfile.write(CIF_TEXT)
+
+    # Only the rows of the _atom_site loop are filtered, by column name
+    output_file = os.path.join(tmpdir, "output.cif")
+    profet.cleaver.Cleaver().remove_nonmain(
+        input_file, [(1, 25)], output_filename=output_file
+    )
+    with open(output_file) as infile:
+        lines = infile.read().splitlines()
+    assert lines[:11] == CIF_TEXT.splitlines()[:11]
+    assert [line.split()[0] for line in lines[17:-1]] == ["3", "4"]
+
+
+def test_fetcher_remove_files(tmpdir, monkeypatch):
+    fetcher = Fetcher(save_directory=str(tmpdir))
+    fetcher.cache()["P12345_1ABC"] = ("pdb", "pdb", "".join(PDB_LINES))
+
+    # The cached files are found without the network
+    def get_pdb(prot_id, filetype="cif"):
+        raise AssertionError("get_pdb called for %s" % prot_id)
+
+    monkeypatch.setattr(fetcher.pdb, "get_pdb", get_pdb)
+    assert fetcher.cache().resolve("p12345")[0] == "p12345_1abc"
+
+    # Each id gets its own outcome, a failure doesn't stop the batch
+    results, errors = fetcher.remove_files(
+        ["P12345", "Q99999"], signal_peptides=False, max_workers=2
+    )
+    assert list(errors) == ["Q99999"]
+    assert "not in cache" in str(errors["Q99999"])
+    expected = os.path.join(
+        tmpdir, "p12345_1abc_nohydrogens_nowater_nohetatm.pdb"
+    )
+    assert results == {"P12345": expected}
+    with open(expected) as infile:
+        assert not any(" HOH " in line for line in infile)
+
+
+@pytest.mark.parametrize("filetype", ["pdb", "cif"])
+def test_cleaver_remove_nonmain_data(tmpdir, filetype):
+    text = "".join(PDB_LINES) if filetype == "pdb" else CIF_TEXT
+    input_file = os.path.join(tmpdir, "test." + filetype)
+    with open(input_file, "w") as outfile:
+        outfile.write(text)
+    output_file = profet.cleaver.Cleaver.remove_nonmain(input_file, [(1, 25)])
+    with open(output_file) as infile:
+        expected = infile.read()
+
+    # Filtering in memory gives the same as filtering the file
+    cleaver = profet.cleaver.Cleaver
+    for engine in ["python", "numpy"]:
+        for data in [text, text.encode(), memoryview(text.encode())]:
+            result = cleaver.remove_nonmain_data(
+                data, filetype, [(1, 25)], engine=engine
+            )
+            if not isinstance(data, str):
+                result = result.decode()
+            assert result == expected
+        chunks = cleaver.remove_nonmain_data(
+            text, filetype, [(1, 25)], engine=engine, stream=True
+        )
+        assert "".join(chunks) == expected
+
+
+def test_fetcher_get_file_clean(tmpdir, monkeypatch):
+    fetcher = Fetcher(save_directory=str(tmpdir))
+    monkeypatch.setattr(fetcher, "check_db", lambda *args, **kw: ["alphafold"])
+    monkeypatch.setattr(
+        fetcher,
+        "file_from_db",
+        lambda prot_id, **kw: (prot_id, "pdb", "".join(PDB_LINES)),
+    )
+    monkeypatch.setattr(
+        fetcher.Cleaver, "signal_residuenumbers_requester", lambda id: [(1, 25)]
+    )
+
+    # The file is cleaned but the cache holds it as downloaded
+    filename, filedata = fetcher.get_file(
+        "P12345", filetype="pdb", filesave=True, clean={"hetatoms": False}
+    )
+    with open(filename) as infile:
+        assert infile.read() == "".join(PDB_LINES)
+    assert filedata == "".join(PDB_LINES[i] for i in [0, 3, 6, 8, 9])
+
+
+def test_cleaver_signal_peptides_batch(tmpdir):
+    class Session:
+        def __init__(self):
+            self.urls = []
+
+        def get(self, url, params=None, **kwargs):
+            self.urls.append(url)
+            if params is None:
+                # A secondary accession the search returns as the primary one
+                return SimpleNamespace(
+                    raw=io.BytesIO(b"<uniprot/>"), close=lambda: None
+                )
+            text = (
+                "Entry\tSignal peptide\n"
+                'P01308\tSIGNAL 1..24; /evidence="ECO:0000269"\n'
+                "P69905\t\n"
+                "Q8WZ42\tSIGNAL <1..?; SIGNAL 1..>20\n"
+            )
+            return SimpleNamespace(text=text, raise_for_status=lambda: None)
+
+    session = Session()
+    cleaver = profet.cleaver.Cleaver(
+        session=session,
+        signal_cache=profet.cache.SignalPeptideCache(str(tmpdir)),
+    )
+    uniprot_ids = ["P01308", "p69905", "Q8WZ42", "Q9XXX1"]
+    expected = {
+        "P01308": [(1, 24)],
+        "p69905": [],
+        "Q8WZ42": [(1, 20)],
+        "Q9XXX1": [],
+    }
+
+    # One search for the batch and a request for the id it didn't return
+    assert cleaver.signal_peptides_batch(uniprot_ids) == expected
+    assert session.urls == [
+        "https://rest.uniprot.org/uniprotkb/stream",
+        cleaver.make_url("Q9XXX1"),
+    ]
+
+    # A rerun needs no requests
+    session.urls = []
+    assert cleaver.signal_peptides_batch(uniprot_ids) == expected
+    assert cleaver.signal_residuenumbers_requester("P01308") == [(1, 24)]
+    assert session.urls == []
+
+
+def test_cleaver_parse_signal_peptides():
+    entry = (
+        b'<?xml version="1.0" encoding="UTF-8"?>\n'
+        b'<uniprot xmlns="http://uniprot.org/uniprot">\n'
+        b'<entry dataset="Swiss-Prot"><accession>P01308</accession>\n'
+        b'<feature type="chain" id="PRO_1"><location>'
+        b'<begin position="25"/><end position="110"/></location></feature>\n'
+        b'<feature type="signal peptide" evidence="1"><location>'
+        b'<begin position="1"/><end position="24"/></location></feature>\n'
+        b'<evidence type="ECO:0000269" key="1"/>\n'
+        b'<sequence length="1000000">'
+        + b"A" * 1000000
+        + b"</sequence>\n</entry>\n</uniprot>\n"
+    )
+
+    # Parsing stops once the features have been read
+    source = io.BytesIO(entry)
+    cleaver = profet.cleaver.Cleaver()
+    assert cleaver.parse_signal_peptides("P01308", source) == [(1, 24)]
+    assert source.tell() < len(entry)
+    assert cleaver.parse_signal_peptides("P01308", entry) == [(1, 24)]
+
+
+def test_alphafold_get_file_url(tmpdir):
+    class Session:
+        def __init__(self):
+            self.urls = []
+
+        def get(self, url, **kwargs):
+            self.urls.append(url)
+            if not url.endswith("/F4HVG8"):
+                return SimpleNamespace(status_code=404)
+            predictions = [
+                {
+                    "entryId": "AF-F4HVG8-F1",
+                    "cifUrl": "https://host/AF-F4HVG8-F1-model_v4.cif",
+                    "pdbUrl": "https://host/AF-F4HVG8-F1-model_v4.pdb",
+                    "latestVersion": 4,
+                }
+            ]
+            return SimpleNamespace(
+                status_code=200,
+                json=lambda: predictions,
+                raise_for_status=lambda: None,
+            )
+
+    session = Session()
+    af_db = alphafold.Alphafold_DB(
+        session=session,
+        prediction_cache=profet.cache.PredictionCache(str(tmpdir)),
+    )
+
+    # The URL is resolved from the API without rendering the entry page
+    url = af_db.get_file_url("f4hvg8", "pdb")
+    assert url == "https://host/AF-F4HVG8-F1-model_v4.pdb"
+    assert session.urls == ["https://alphafold.ebi.ac.uk/api/prediction/F4HVG8"]
+    with pytest.raises(RuntimeError):
+        af_db.get_file_url("P12345", "cif")
+
+    # And the resolved URLs are remembered
+    af_db = alphafold.Alphafold_DB(
+        session=session,
+        prediction_cache=profet.cache.PredictionCache(str(tmpdir)),
+    )
+    session.urls = []
+    assert af_db.make_url("F4HVG8", "cif").endswith("model_v4.cif")
+    assert af_db.get_file_url("F4HVG8", "cif").endswith("model_v4.cif")
+    assert session.urls == []
+
+
+@pytest.mark.parametrize(
+    "statement, allowed",
+    [
+        ("import profet", []),
+        ("import profet.command_line", []),
+        ("from profet import Fetcher", ["requests"]),
+        ("import profet; profet.cache.PDBFileCache", []),
+    ],
+)
+def test_import_is_lazy(statement, allowed):
+    # The slow dependencies are only imported once they are needed
+    heavy = ["numpy", "requests", "rcsbsearchapi", "requests_html", "bs4"]
+    heavy += ["lxml", "httpx", "pandas"]
+    code = "import sys; %s; print(' '.join(m for m in %r if m in sys.modules))"
+    output = subprocess.run(
+        [sys.executable, "-c", code % (statement, heavy)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    assert sorted(output.split()) == allowed
+
+
+def test_fetcher_init_is_lazy(tmpdir):
+    # Making a fetcher doesn't touch the cache directory
+    directory = os.path.join(tmpdir, "cache")
+    fetcher = Fetcher(save_directory=directory)
+    assert not os.path.exists(directory)
+
+    # Until a cache is used
+    assert fetcher.pdb.id_cache.get("P45523") is None
+    assert os.listdir(directory) == ["cache.sqlite"]
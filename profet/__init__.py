@@ -3,4 +3,39 @@ try:
 except ImportError:
     __version__ = "unknown"
 
-from .profet import Fetcher
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .profet import Fetcher
+
+__all__ = ["Fetcher"]
+
+_submodules = [
+    "aio",
+    "alphafold",
+    "cache",
+    "cleaver",
+    "command_line",
+    "index",
+    "mmcif",
+    "pdb",
+    "profet",
+    "session",
+    "sifts",
+]
+
+
+def __getattr__(name: str):
+    """
+    Import the fetcher and the submodules on first use, so that importing
+    profet is fast
+
+    """
+    if name == "Fetcher":
+        from .profet import Fetcher
+
+        return Fetcher
+    if name in _submodules:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,584 @@
+"""An asyncio counterpart of the Fetcher built on httpx
+
+Install with the async extra to use it: pip install profet[async]"""
+
+from .alphafold import Alphafold_DB
+from .pdb import PDB_DB
+from .index import AlphafoldIndex
+from .cache import (
+    PDBFileCache,
+    NegativeCache,
+    PDBIdCache,
+    PredictionCache,
+    SignalPeptideCache,
+    open_file,
+)
+from .cleaver import Cleaver
+from .sifts import SIFTSIndex
+import asyncio
+import functools
+import gzip
+import importlib.util
+import httpx
+
+
+def read_file(filename: str) -> str:
+    """
+    Read a cached file
+
+    Args:
+        filename: The name of the file
+
+    Returns:
+        The contents of the file
+
+    """
+    with open_file(filename) as infile:
+        return infile.read()
+
+
+def save_file(
+    cache: PDBFileCache,
+    identifier: str,
+    fileorigin: str,
+    filetype: str,
+    filedata: str,
+) -> str:
+    """
+    Save a file into the cache
+
+    Args:
+        cache: The file cache
+        identifier: The identifier of the file
+        fileorigin: The database the file came from
+        filetype: The file type: cif, pdb
+        filedata: The contents of the file
+
+    Returns:
+        The name of the saved file
+
+    """
+    cache[identifier] = (fileorigin, filetype, filedata)
+    return cache[identifier]
+
+
+class AsyncFetcher:
+    """
+    Fetch protein structures from the PDB and alphafold databases without
+    blocking the event loop.
+
+    All HTTP requests share one httpx client and are bounded by a semaphore
+    so that at most max_concurrency requests are in flight at a time.
+
+    """
+
+    def __init__(
+        self,
+        main_db: str = "pdb",
+        save_directory: str = None,
+        max_concurrency: int = 16,
+        http2: bool = True,
+        client: httpx.AsyncClient = None,
+        negative_ttl: float = 7 * 24 * 3600,
+        id_ttl: float = 30 * 24 * 3600,
+        sifts: str = None,
+        alphafold_accessions: str = None,
+        codec: str = None,
+        signal_ttl: float = 30 * 24 * 3600,
+    ):
+        """
+        Initialise the fetcher
+
+        Args:
+            main_db: The default database (pdb or alphafold)
+            save_directory: The cache directory
+            max_concurrency: The maximum number of requests in flight
+            http2: Multiplex requests over HTTP/2 if h2 is installed
+            client: An optional httpx client to use instead of our own
+            negative_ttl: How long to remember that an id is not available
+                in a database, in seconds
+            id_ttl: How long to remember the PDB ids matching a uniprot id,
+                and the AlphaFold files of one, in seconds
+            sifts: A SIFTS pdb_chain_uniprot TSV file, or an index built
+                from one, to look up PDB ids without searching
+            alphafold_accessions: The AlphaFold accession_ids.csv file, or an
+                index built from one, to look up models without probing
+            codec: Compress the saved files with gzip or zstd
+            signal_ttl: How long to remember the signal peptides of a uniprot
+                id, in seconds
+
+        """
+        self.type = main_db
+        self.pdb = PDB_DB(
+            id_cache=PDBIdCache(directory=save_directory, ttl=id_ttl),
+            sifts_index=SIFTSIndex.from_file(sifts) if sifts else None,
+        )
+        self.alpha = Alphafold_DB(
+            accession_index=AlphafoldIndex.from_file(alphafold_accessions)
+            if alphafold_accessions
+            else None,
+            prediction_cache=PredictionCache(
+                directory=save_directory, ttl=id_ttl
+            ),
+        )
+        self.Cleaver = Cleaver(
+            signal_cache=SignalPeptideCache(
+                directory=save_directory, ttl=signal_ttl
+            )
+        )
+        self.search_results = {}  # type: ignore
+        self.save_directory = save_directory
+        self.negative_ttl = negative_ttl
+        self.codec = codec
+        self.max_concurrency = max_concurrency
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        self.client = client
+        self.semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def aclose(self):
+        """
+        Close the HTTP client
+
+        """
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        Perform an HTTP request on the shared client
+
+        Args:
+            method: The HTTP method
+            url: The URL of the request
+            kwargs: Extra arguments passed to the httpx client
+
+        Returns:
+            The response
+
+        """
+        # Create these lazily so they are bound to the running loop
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http2=self.http2,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=self.max_concurrency),
+            )
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self.semaphore:
+            return await self.client.request(method, url, **kwargs)
+
+    async def _run(self, function, *args, **kwargs):
+        """
+        Run a blocking function, such as cache or file access, in a thread
+
+        Args:
+            function: The function to call
+            args: Positional arguments passed to the function
+            kwargs: Keyword arguments passed to the function
+
+        Returns:
+            The return value of the function
+
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(function, *args, **kwargs)
+        )
+
+    async def uniprot_id_to_pdb_id(self, uniprot_id: str):
+        """
+        Convert a uniprot_id to a pdb_id by selecting first entry
+
+        The local lookups are tried before searching and the PDB ids cache
+        is updated after.
+
+        Args:
+            uniprot_id: The uniprot id of the protein
+
+        Returns:
+            The PDB id
+
+        """
+        pdb_ids = await self._run(self.pdb.local_pdb_ids, uniprot_id)
+        if pdb_ids is None:
+            pdb_ids = await self.search_pdb_ids(uniprot_id)
+            await self._run(self.pdb.id_cache.__setitem__, uniprot_id, pdb_ids)
+        return pdb_ids[0] if pdb_ids else None
+
+    async def search_pdb_ids(self, uniprot_id: str) -> list:
+        """
+        Search the PDB for the ids matching a uniprot_id
+
+        Args:
+            uniprot_id: The uniprot id of the protein
+
+        Returns:
+            The list of PDB ids
+
+        """
+        response = await self._request(
+            "POST",
+            self.pdb.search_url,
+            json=self.pdb.search_request(uniprot_id),
+        )
+        response.raise_for_status()
+
+        # The search returns no content if nothing matches
+        if response.status_code == 204:
+            return []
+        return [
+            result["identifier"]
+            for result in response.json().get("result_set", [])
+        ]
+
+    async def check_pdb(self, uniprot_id: str) -> bool:
+        """
+        Check if a protein is contained within the PDB
+
+        Args:
+            uniprot_id: The uniprot id of the protein
+
+        Returns:
+            Is the protein in the PDB (True/False)
+
+        """
+        pdb_id = await self.uniprot_id_to_pdb_id(uniprot_id)
+        if pdb_id is not None:
+            self.pdb.results[uniprot_id.upper()] = pdb_id
+            return True
+        return False
+
+    async def check_alphafold(self, uniprot_id: str) -> bool:
+        """
+        Check whether a structure is present in the AlphaFold database
+
+        Args:
+            uniprot_id: The uniprot id of the protein
+
+        Returns:
+            Is the protein in the Alphafold database (True/False)
+
+        """
+        if self.alpha.accession_index is not None:
+            return uniprot_id.upper() in self.alpha.accession_index
+
+        # The API describes the models without transferring them
+        try:
+            return await self.get_prediction(uniprot_id) is not None
+        except (httpx.HTTPError, ValueError):
+            pass
+
+        # Otherwise only ask for the headers of the guessed file
+        url = self.alpha.guess_url(uniprot_id, "pdb")
+        response = await self._request("HEAD", url)
+        return response.status_code != 404
+
+    async def get_prediction(self, uniprot_id: str):
+        """
+        Get the AlphaFold model of a protein, from the cache or the API
+
+        Args:
+            uniprot_id: The uniprot id of the protein
+
+        Returns:
+            The dictionary of the cif and pdb file URLs and the version of
+            the model, or None if there is no model
+
+        """
+        uniprot_id = uniprot_id.upper()
+        cache = self.alpha.prediction_cache
+        prediction = await self._run(cache.get, uniprot_id)
+        if prediction is not None:
+            return prediction
+
+        response = await self._request(
+            "GET", self.alpha.make_api_url(uniprot_id)
+        )
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        prediction = self.alpha.parse_prediction(response.json())
+        if prediction is not None:
+            await self._run(cache.__setitem__, uniprot_id, prediction)
+        return prediction
+
+    async def check_db(self, uniprot_id: str, refresh: bool = False) -> list:
+        """
+        Checks which database contains the searched ID.
+
+        Databases recently found not to have the structure are skipped
+        unless refresh is set.
+
+        Args:
+            uniprot_id: ID from Uniprot
+            refresh: Ignore what is known about missing structures
+
+        Returns:
+            The list of the databases where the id is available
+
+        """
+
+        # Get the databases known not to have the structure
+        negative_cache = await self._run(
+            NegativeCache, directory=self.save_directory, ttl=self.negative_ttl
+        )
+        if refresh:
+            await self._run(negative_cache.remove, uniprot_id)
+        missing_db = await self._run(negative_cache.missing, uniprot_id)
+
+        # Check the other databases concurrently
+        checks = {"pdb": self.check_pdb, "alphafold": self.check_alphafold}
+        dbs = [db for db in checks if db not in missing_db]
+        found = await asyncio.gather(*[checks[db](uniprot_id) for db in dbs])
+
+        # Remember where the structure was not found
+        await self._run(
+            negative_cache.add,
+            uniprot_id,
+            [db for db, is_found in zip(dbs, found) if not is_found],
+        )
+        return [db for db, is_found in zip(dbs, found) if is_found]
+
+    async def get_pdb(self, uniprot_id: str, filetype: str = "cif") -> tuple:
+        """
+        Returns pdb/cif as strings from the PDB
+
+        The files are transferred gzip compressed.
+
+        Args:
+            uniprot_id: ID from Uniprot
+            filetype: File type to be retrieved: cif, pdb
+
+        Returns:
+            Tuple containing the identifier, file type and file contents
+
+        """
+        key = uniprot_id.upper()
+        if key not in self.pdb.results:
+            self.pdb.results[key] = await self.uniprot_id_to_pdb_id(uniprot_id)
+        pdb_id = self.pdb.results[key]
+
+        # Try the other file type if the requested one is not available
+        response = await self._request(
+            "GET", self.pdb.make_url(pdb_id, filetype, compressed=True)
+        )
+        if response.is_error:
+            filetype = "cif" if filetype == "pdb" else "pdb"
+            response = await self._request(
+                "GET", self.pdb.make_url(pdb_id, filetype, compressed=True)
+            )
+            response.raise_for_status()
+
+        filedata = await self._run(gzip.decompress, response.content)
+        return (
+            self.pdb.make_identifier(uniprot_id, pdb_id),
+            filetype,
+            filedata.decode(),
+        )
+
+    async def get_alphafold(
+        self, uniprot_id: str, filetype: str = "cif"
+    ) -> tuple:
+        """
+        Returns pdb/cif as strings from the Alphafold database
+
+        Args:
+            uniprot_id: ID from Uniprot
+            filetype: File type to be retrieved: cif, pdb
+
+        Returns:
+            Tuple containing the identifier, file type and file contents
+
+        """
+        # Resolve the URL from the API unless there is an accession index
+        prediction = None
+        if self.alpha.accession_index is None:
+            try:
+                prediction = await self.get_prediction(uniprot_id)
+            except (httpx.HTTPError, ValueError):
+                pass
+        if prediction is not None and prediction.get(filetype):
+            url = prediction[filetype]
+        else:
+            url = self.alpha.guess_url(uniprot_id, filetype)
+        response = await self._request("GET", url)
+
+        # Ask the API if the guessed URL gave a placeholder
+        if len(response.content) < 200 and prediction is None:
+            prediction = await self.get_prediction(uniprot_id)
+            if prediction is None or not prediction.get(filetype):
+                raise RuntimeError(
+                    "No AlphaFold %s file found for %s" % (filetype, uniprot_id)
+                )
+            response = await self._request("GET", prediction[filetype])
+        return uniprot_id, filetype, response.text
+
+    async def file_from_db(
+        self,
+        prot_id: str,
+        filetype: str = "cif",
+        db: str = "pdb",
+    ) -> tuple:
+        """
+        Returns the file from the correspondent database.
+
+        Args:
+            prot_id: ID from Uniprot.
+            filetype: File type to be retrieved: cif, pdb.
+            db: database from which to retrieve the file.
+
+        Returns:
+            Tuple containing the identifier, file type and file contents
+
+        """
+        return await {"pdb": self.get_pdb, "alphafold": self.get_alphafold}[db](
+            prot_id, filetype=filetype
+        )
+
+    async def get_file(
+        self,
+        uniprot_id: str,
+        filetype: str = "cif",
+        filesave: bool = False,
+        db: str = "pdb",
+        refresh: bool = False,
+    ) -> tuple:
+        """
+        Returns the file from an available database, starting with the
+        default that the user provided.
+
+        Args:
+            uniprot_id: ID from Uniprot.
+            filetype: File type to be retrieved: cif, pdb.
+            filesave: Option to save into a file.
+            db: database from which to retrieve the file.
+            refresh: Ignore what is known about missing structures.
+
+        Returns:
+            A tuple containing:
+            1. File name of the saved file
+            2. File from the database
+
+        """
+
+        # Get the PDB cache
+        cache = await self._run(
+            PDBFileCache, directory=self.save_directory, codec=self.codec
+        )
+
+        # If the file is already downloaded then use that, unless another
+        # process removed it since. Structures from the PDB are cached under
+        # the uniprot id and the PDB id
+        found = await self._run(cache.resolve, uniprot_id, filetype)
+        if found is not None:
+            try:
+                return found[1], await self._run(read_file, found[1])
+            except FileNotFoundError:
+                cache.forget(found[0], filetype)
+
+        # Otherwise search in the PDB or alphafold databases
+        self.search_results[uniprot_id] = await self.check_db(
+            uniprot_id, refresh=refresh
+        )
+        available_db = self.search_results[uniprot_id]
+        if len(available_db) == 0:
+            raise RuntimeError(
+                "Structure %s not available on any database" % uniprot_id
+            )
+        fileorigin = db if db in available_db else available_db[0]
+        identifier, filetype, filedata = await self.file_from_db(
+            prot_id=uniprot_id, filetype=filetype, db=fileorigin
+        )
+
+        # Optionally save the data
+        if filesave:
+            filename = await self._run(
+                save_file, cache, identifier, fileorigin, filetype, filedata
+            )
+        else:
+            filename = None
+
+        # Return the filename and file
+        return filename, filedata
+
+    async def get_files(
+        self,
+        uniprot_ids: list,
+        filetype: str = "cif",
+        filesave: bool = False,
+        db: str = "pdb",
+        refresh: bool = False,
+    ) -> tuple:
+        """
+        Returns the files for many ids, fetching them concurrently.
+
+        A failure to fetch one id does not abort the batch; the exception is
+        returned alongside the successful results instead.
+
+        Args:
+            uniprot_ids: IDs from Uniprot.
+            filetype: File type to be retrieved: cif, pdb.
+            filesave: Option to save into a file.
+            db: database from which to retrieve the file.
+            refresh: Ignore what is known about missing structures.
+
+        Returns:
+            A tuple containing:
+            1. A dictionary of (filename, filedata) tuples keyed by id
+            2. A dictionary of exceptions keyed by the ids that failed
+
+        """
+        uniprot_ids = list(dict.fromkeys(uniprot_ids))
+        outcomes = await asyncio.gather(
+            *[
+                self.get_file(
+                    uniprot_id,
+                    filetype=filetype,
+                    filesave=filesave,
+                    db=db,
+                    refresh=refresh,
+                )
+                for uniprot_id in uniprot_ids
+            ],
+            return_exceptions=True,
+        )
+        results = {}
+        errors = {}
+        for uniprot_id, outcome in zip(uniprot_ids, outcomes):
+            if isinstance(outcome, Exception):
+                errors[uniprot_id] = outcome
+            else:
+                results[uniprot_id] = outcome
+        return results, errors
+
+    async def signal_residuenumbers_requester(self, uniprot_id: str) -> list:
+        """
+        Collects all residue positions of the signal peptides to cleave.
+
+        Args:
+            uniprot_id: ID from Uniprot
+
+        Returns:
+            The list of the pairs of starting and end position in number of
+            amino acids of the signal peptides given by UniProt.
+
+        """
+        cache = self.Cleaver.signal_cache
+        signal_list = await self._run(cache.get, uniprot_id)
+        if signal_list is not None:
+            return [tuple(signal) for signal in signal_list]
+
+        response = await self._request("GET", self.Cleaver.make_url(uniprot_id))
+        signal_list = self.Cleaver.parse_signal_peptides(
+            uniprot_id, response.content
+        )
+        await self._run(cache.__setitem__, uniprot_id, signal_list)
+        return signal_list
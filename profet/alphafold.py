@@ -6,9 +6,13 @@ https://alphafold.ebi.ac.uk/files/AF-F4HVG8-F1-predicted_aligned_error_v2.json
 read entry: https://alphafold.ebi.ac.uk/entry/F4HVG8
 find cif, download that file"""
 
-from requests_html import HTMLSession
+from .cache import PredictionCache, compress_chunks, uncompressed_size
+from .index import AlphafoldIndex
+from .session import PooledSession
+from contextlib import closing
+import gzip
+import itertools
 import requests
-from bs4 import BeautifulSoup
 
 
 class Alphafold_DB:
@@ -17,17 +21,60 @@ class Alphafold_DB:
 
     """
 
-    def __init__(self):
+    # The model version to download if it isn't known from the index
+    default_version = 3
+
+    # The size of the chunks of a streamed download
+    chunk_size = 1 << 16
+
+    # The API describing the models of an accession
+    api_url = "https://alphafold.ebi.ac.uk/api/prediction/"
+
+    def __init__(
+        self,
+        session: requests.Session = None,
+        accession_index: AlphafoldIndex = None,
+        prediction_cache: PredictionCache = None,
+        render: bool = False,
+    ):
         """
         Initialise the Alphafold data base class
 
+        Args:
+            session: The HTTP session to download files with
+            accession_index: A local index of the AlphaFold accessions to
+                use instead of probing the server
+            prediction_cache: The cache of the models resolved from the
+                AlphaFold API, by default kept in memory
+            render: Render the entry page in a headless browser to find the
+                file URL if the API doesn't give it, this needs the render
+                extra
+
         """
-        # self.df = pd.read_csv("http://ftp.ebi.ac.uk/pub/databases/alphafold/accession_ids.csv",
-        #                      names=["Uniprot_ID", "First_residue", "Last_residue", "AF_ID", "version"], encoding="iso-8859-1")
-        self.df = None
-        self.session = HTMLSession()
+        self.accession_index = accession_index
+        self.session = session
+        self.prediction_cache = (
+            prediction_cache if prediction_cache is not None else {}
+        )
+        self.render = render
+        self.html_session = None
         self.common_url = "https://alphafold.ebi.ac.uk/entry/"
 
+    @property
+    def session(self) -> requests.Session:
+        """
+        Returns:
+            The HTTP session, created on first use unless one was given
+
+        """
+        if self._session is None:
+            self._session = PooledSession()
+        return self._session
+
+    @session.setter
+    def session(self, session: requests.Session):
+        self._session = session
+
     def check_structure(self, uniprot_id: str) -> bool:
         """
         Check whether a structure is present in the AlphaFold database
@@ -40,13 +87,26 @@ class Alphafold_DB:
 
         """
         uniprot_id = uniprot_id.upper()
-        url = self.make_url(uniprot_id, "pdb")
-        r = requests.get(url)
+        if self.accession_index is not None:
+            return uniprot_id in self.accession_index
+
+        # The API describes the models without transferring them
+        try:
+            return self.get_prediction(uniprot_id) is not None
+        except (requests.RequestException, ValueError):
+            pass
+
+        # Otherwise only ask for the headers of the guessed file
+        url = self.guess_url(uniprot_id, "pdb")
+        r = self.session.head(url, allow_redirects=True)
         return r.status_code != 404
 
     def get_file_url(self, uniprot_id: str, filetype: str = "cif") -> str:
         """
-        Get file url relative to an id from the the Alphafold entry page
+        Get file url relative to an id from the AlphaFold API
+
+        The entry page is only rendered to find the URL if the API doesn't
+        give it and render is set.
 
         Args:
             uniprot_id: The uniprot id of the protein
@@ -58,21 +118,116 @@ class Alphafold_DB:
         """
 
         # Do we recognise the filetpye, otherwise raise an exception.
-        if filetype in ["pdb", "cif"]:
-            uniprot_id = uniprot_id.upper()
-            # Get the url with the id.
-            response = self.session.get(self.common_url + uniprot_id)
+        if filetype not in ["pdb", "cif"]:
+            raise RuntimeError("Filetype not supported: %s" % filetype)
 
-            # Render the javascript.
-            response.html.render()
+        prediction = self.get_prediction(uniprot_id)
+        if prediction is not None and prediction.get(filetype):
+            return prediction[filetype]
+        if not self.render:
+            raise RuntimeError(
+                "No AlphaFold %s file found for %s" % (filetype, uniprot_id)
+            )
+        return self.render_file_url(uniprot_id, filetype)
 
-            # Parse the rendered html.
-            soup = BeautifulSoup(response.html.html, "lxml")
+    def make_api_url(self, uniprot_id: str) -> str:
+        """
+        Make the URL of the AlphaFold API entry of the protein
 
-            # Find url correspondent to the intended filetype.
-            url = soup.select_one("a[href*=" + filetype + "]")
-        else:
-            raise RuntimeError("Filetype not supported: %s" % filetype)
+        Args:
+            uniprot_id: The uniprot id of the protein
+
+        Returns:
+            The URL of the JSON description of the models
+
+        """
+        return self.api_url + uniprot_id.upper()
+
+    def get_prediction(self, uniprot_id: str):
+        """
+        Get the AlphaFold model of a protein, from the cache or the API
+
+        Args:
+            uniprot_id: The uniprot id of the protein
+
+        Returns:
+            The dictionary of the cif and pdb file URLs and the version of
+            the model, or None if there is no model
+
+        """
+        uniprot_id = uniprot_id.upper()
+        prediction = self.prediction_cache.get(uniprot_id)
+        if prediction is not None:
+            return prediction
+
+        response = self.session.get(self.make_api_url(uniprot_id))
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        prediction = self.parse_prediction(response.json())
+        if prediction is not None:
+            self.prediction_cache[uniprot_id] = prediction
+        return prediction
+
+    def parse_prediction(self, predictions: list):
+        """
+        Parse the model of the first fragment from an AlphaFold API response
+
+        Args:
+            predictions: The list of models given by the API
+
+        Returns:
+            The dictionary of the cif and pdb file URLs and the version of
+            the model, or None if there is no model
+
+        """
+        if not predictions:
+            return None
+
+        # Proteins too long to model in one piece have several fragments
+        prediction = next(
+            (p for p in predictions if p.get("entryId", "").endswith("-F1")),
+            predictions[0],
+        )
+        return {
+            "cif": prediction.get("cifUrl"),
+            "pdb": prediction.get("pdbUrl"),
+            "version": prediction.get("latestVersion"),
+        }
+
+    def render_file_url(self, uniprot_id: str, filetype: str = "cif") -> str:
+        """
+        Get file url relative to an id from the rendered Alphafold entry page
+
+        This starts a headless browser, which is slow and needs the render
+        extra: pip install profet[render]
+
+        Args:
+            uniprot_id: The uniprot id of the protein
+            filetype: The type of file to download (pdb or cif)
+
+        Returns:
+            The URL of the file to download
+
+        """
+        from requests_html import HTMLSession
+        from bs4 import BeautifulSoup
+
+        if self.html_session is None:
+            self.html_session = HTMLSession()
+
+        uniprot_id = uniprot_id.upper()
+        # Get the url with the id.
+        response = self.html_session.get(self.common_url + uniprot_id)
+
+        # Render the javascript.
+        response.html.render()
+
+        # Parse the rendered html.
+        soup = BeautifulSoup(response.html.html, "lxml")
+
+        # Find url correspondent to the intended filetype.
+        url = soup.select_one("a[href*=" + filetype + "]")
 
         # Return the URL
         return url["href"]
@@ -81,6 +236,35 @@ class Alphafold_DB:
         """
         Make the URL for the protein
 
+        Without an accession index the URL is resolved from the AlphaFold
+        API, and cached, and the URL is only guessed if the API can't be
+        asked.
+
+        Args:
+            uniprot_id: The uniprot id of the protein
+            filetype: The type of file to download (pdb or cif)
+
+        Returns:
+            The URL of the file to download
+
+        """
+        uniprot_id = uniprot_id.upper()
+        if self.accession_index is None:
+            try:
+                prediction = self.get_prediction(uniprot_id)
+            except (requests.RequestException, ValueError):
+                prediction = None
+            if prediction is not None and prediction.get(filetype):
+                return prediction[filetype]
+        return self.guess_url(uniprot_id, filetype)
+
+    def guess_url(self, uniprot_id: str, filetype: str = "cif") -> str:
+        """
+        Guess the URL for the protein without the network
+
+        The model version is the latest one in the accession index if there
+        is one, otherwise the default version.
+
         Args:
             uniprot_id: The uniprot id of the protein
             filetype: The type of file to download (pdb or cif)
@@ -94,7 +278,11 @@ class Alphafold_DB:
         af_id = "AF-" + uniprot_id + "-F1"
 
         # https: // alphafold.ebi.ac.uk / files / AF - A0A6J1BG53 - F1 - model_v3.pdb
-        version = 3
+        version = None
+        if self.accession_index is not None:
+            version = self.accession_index.latest_version(uniprot_id)
+        if version is None:
+            version = self.default_version
         url = (
             "https://alphafold.ebi.ac.uk/files/"
             + af_id
@@ -110,35 +298,116 @@ class Alphafold_DB:
         self,
         uniprot_id: str,
         filetype: str = "cif",
+        compressed: bool = False,
+        stream: bool = False,
     ) -> tuple:
         """
         Returns pdb/cif as strings, saves to file if requested.
 
+        The files are transferred gzip compressed if the server supports it.
+
         Args:
             uniprot_id: ID from Uniprot
             filetype: File type to be retrieved: cif, pdb
-            filedir: The directory to save the data
+            compressed: Return the file gzip compressed, as bytes
+            stream: Return an iterator of the file data as bytes chunks
+                instead, which reads the download as it is consumed
 
         Returns:
             Tuple containing the filename and file from the database
 
         """
-        # af_id = self.df.loc[self.df['Uniprot_ID'] == uniprot_id.upper()]["AF_ID"].to_numpy()[0]
-        # version = self.df.loc[self.df['Uniprot_ID'] == uniprot_id.upper()]["version"].to_numpy()[0]
-        # af_id = "AF-"+uniprot_id+"-F1"
-
-        # https: // alphafold.ebi.ac.uk / files / AF - A0A6J1BG53 - F1 - model_v3.pdb
-        # version = 3
-        # url = "https://alphafold.ebi.ac.uk/files/" + af_id + "-model_v" + str(version) + "." + filetype
-
         # Make the URL
         url = self.make_url(uniprot_id, filetype)
 
-        # Perform the HTML request to get the file
-        file = requests.get(url)
-        if len(file.content) < 200:
+        # Stream the file if it is not missing or a placeholder
+        if stream:
+            filedata = self.stream(url, compressed, min_size=200)
+            if filedata is None:
+                url = self.get_file_url(uniprot_id, filetype)
+                filedata = self.stream(url, compressed)
+            return uniprot_id, filetype, filedata
+
+        # Perform the HTML request to get the file, resolving the URL again
+        # if the file is missing or a placeholder
+        try:
+            filedata = self.download(url, compressed)
+            size = (
+                uncompressed_size(filedata, "gzip")
+                if compressed
+                else len(filedata)
+            )
+        except requests.HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+            size = 0
+        if size < 200:
             url = self.get_file_url(uniprot_id, filetype)
-            file = requests.get(url)
+            filedata = self.download(url, compressed)
 
         # Return the filename and file contents
-        return uniprot_id, filetype, file.text
+        return uniprot_id, filetype, filedata
+
+    def download(self, url: str, compressed: bool = False):
+        """
+        Download a file
+
+        Args:
+            url: The URL of the file
+            compressed: Return the file gzip compressed
+
+        Returns:
+            The gzip compressed bytes, or the text
+
+        """
+        if not compressed:
+            response = self.session.get(url)
+            response.raise_for_status()
+            return response.text
+
+        # Keep the body as it was transferred if it is gzip encoded, and
+        # compress the decoded body of any other encoding
+        response = self.session.get(
+            url, headers={"Accept-Encoding": "gzip"}, stream=True
+        )
+        with closing(response):
+            response.raise_for_status()
+            is_gzip = response.headers.get("Content-Encoding") == "gzip"
+            filedata = response.raw.read(decode_content=not is_gzip)
+        return filedata if is_gzip else gzip.compress(filedata)
+
+    def stream(self, url: str, compressed: bool = False, min_size: int = 0):
+        """
+        Download a file a chunk at a time
+
+        Args:
+            url: The URL of the file
+            compressed: Gzip compress the chunks
+            min_size: The size below which the file is not returned
+
+        Returns:
+            An iterator of the file data as bytes chunks, or None if the
+            file is missing or smaller than min_size
+
+        """
+        response = self.session.get(url, stream=True)
+
+        # Don't return an error page as the file
+        if not response.ok:
+            response.close()
+            if response.status_code == 404:
+                return None
+            response.raise_for_status()
+        chunks = response.iter_content(self.chunk_size)
+
+        # Read enough of the file to check its size
+        head = b""
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= min_size:
+                break
+        if len(head) < min_size:
+            response.close()
+            return None
+        chunks = itertools.chain([head], chunks)
+        return compress_chunks(chunks) if compressed else chunks
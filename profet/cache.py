@@ -1,14 +1,288 @@
+from contextlib import closing, contextmanager, suppress
+import atexit
+import gzip
+import hashlib
 import json
 import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+def cache_directory(directory: str = None) -> str:
+    """
+    Get the cache directory, creating it if it doesn't exist
+
+    If directory is None then the cache is set to ~/.cache/pdb
+
+    Args:
+        directory: The cache directory
+
+    Returns:
+        The absolute path of the cache directory
+
+    """
+    directory = os.path.abspath(
+        directory
+        if directory is not None
+        else os.path.abspath(
+            os.path.expanduser(os.path.join("~", ".cache", "pdb"))
+        )
+    )
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+# The file extension of each compression codec
+codecs = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def open_file(filename: str, mode: str = "rt"):
+    """
+    Open a file, compressing or decompressing it according to its extension
+
+    Args:
+        filename: The filename
+        mode: The mode to open the file with
+
+    Returns:
+        The file object
+
+    """
+    if filename.endswith(codecs["gzip"]):
+        return gzip.open(filename, mode)
+    if filename.endswith(codecs["zstd"]):
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError(
+                "Install zstandard to use zstd compressed files: %s" % filename
+            )
+        return zstandard.open(filename, mode)
+    return open(filename, mode)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    """
+    Decompress data
+
+    Args:
+        data: The compressed data
+        codec: The compression codec (gzip or zstd)
+
+    Returns:
+        The decompressed data
+
+    """
+    if codec == "gzip":
+        return gzip.decompress(data)
+    import zstandard
+
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+def uncompressed_size(data: bytes, codec: str) -> int:
+    """
+    Get the size of compressed data once decompressed
+
+    Args:
+        data: The compressed data
+        codec: The compression codec (gzip or zstd)
+
+    Returns:
+        The size in bytes
+
+    """
+    # The gzip trailer holds the size modulo 2^32
+    if codec == "gzip" and len(data) >= 4:
+        return int.from_bytes(data[-4:], "little")
+    return len(decompress(data, codec))
+
+
+def compress_chunks(chunks):
+    """
+    Gzip compress an iterable of chunks as they are read
+
+    Args:
+        chunks: An iterable of the data as bytes
+
+    Returns:
+        An iterator of the compressed data
+
+    """
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def decompress_chunks(chunks, codec: str):
+    """
+    Decompress an iterable of chunks as they are read
+
+    Args:
+        chunks: An iterable of the compressed data as bytes
+        codec: The compression codec (gzip or zstd)
+
+    Returns:
+        An iterator of the decompressed data
+
+    """
+    if codec == "gzip":
+        decompressor = zlib.decompressobj(wbits=31)
+    else:
+        import zstandard
+
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    for chunk in chunks:
+        chunk = decompressor.decompress(chunk)
+        if chunk:
+            yield chunk
+    if codec == "gzip":
+        yield decompressor.flush()
+
+
+def split_filename(filename: str):
+    """
+    Split a structure filename into its identifier, file type and codec
+
+    Args:
+        filename: The filename, e.g. 4v5d.cif.gz
+
+    Returns:
+        The tuple (identifier, filetype, codec), or None if the filename is
+        not that of a structure
+
+    """
+    name = os.path.basename(filename)
+    codec = None
+    for key, extension in codecs.items():
+        if name.endswith(extension):
+            name = name[: -len(extension)]
+            codec = key
+    identifier, extension = os.path.splitext(name)
+    if extension not in [".pdb", ".cif"]:
+        return None
+    return identifier, extension[1:], codec
+
+
+def connect(filename: str) -> sqlite3.Connection:
+    """
+    Connect to an SQLite database in the cache directory
+
+    The connection is in autocommit mode, use transaction to group
+    statements.
+
+    Args:
+        filename: The database filename
+
+    Returns:
+        The connection
+
+    """
+    return sqlite3.connect(filename, timeout=60, isolation_level=None)
+
+
+@contextmanager
+def transaction(connection: sqlite3.Connection, write: bool = True):
+    """
+    Run the statements in the block in one transaction
+
+    A write transaction takes the database lock when it begins rather than
+    at its first write, so that processes reading then writing queue on the
+    lock instead of deadlocking and failing.
+
+    Args:
+        connection: The connection
+        write: Whether the transaction writes to the database
+
+    """
+    connection.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
 
 
 class PDBFileCache(object):
     """
     A class to cache the PDB files
 
+    The manifest of the files in the cache is a table in an SQLite database
+    in the cache directory, indexed by identifier, origin and file type.
+
+    The files in each cache directory are listed once into an in memory
+    index shared by all the cache objects of the process, so that lookups
+    don't need to stat the files. Files added to the directory by other
+    processes, uncompressed or with the codec of the cache object, are found
+    when looked up. Files removed by them are forgotten when they fail to
+    open, or call refresh to rescan the directory.
+
+    The files are either all in the cache directory (the flat layout) or
+    spread over two levels of subdirectories named after a hash of the
+    identifier (the sharded layout), which keeps directories small for
+    caches with millions of files. The layout is recorded in the database
+    and changed with migrate.
+
+    Files can be stored compressed with gzip or zstd (which needs the
+    zstandard package). Reading them with open decompresses them whatever
+    the codec of the cache object, so compressed and uncompressed files can
+    be mixed in one cache.
+
+    With a maximum size set, the time and number of accesses of each item
+    are recorded in the manifest, and the least recently (lru) or least
+    frequently (lfu) used items are evicted when the files in the cache grow
+    over it. The accesses are held in memory for all the cache objects of
+    the process and recorded in batches, on writes, and at exit. The total size is kept up to date in the database, so checking
+    it doesn't need a scan.
+
     """
 
-    def __init__(self, directory: str = None):
+    # The directory layouts
+    layouts = ["flat", "sharded"]
+
+    # The eviction policies and the order in which they evict items
+    policies = {"lru": "accessed", "lfu": "hits, accessed"}
+
+    # The fraction of the maximum size to evict down to, so that a full
+    # cache isn't pruned again on every write
+    low_water = 0.9
+
+    # The number of accesses to hold in memory, and the longest time in
+    # seconds to hold them, before recording them in the manifest
+    access_batch = 100
+    access_interval = 60
+
+    # The version of the tables, recorded in the database when they are
+    # created or updated
+    schema_version = 1
+
+    # The directory layout of each cache directory
+    _layouts = {}  # type: ignore
+
+    # The in memory indices of the files in each cache directory
+    _indices = {}  # type: ignore
+    _index_lock = threading.Lock()
+
+    # The accesses not yet recorded in each cache directory, (time, hits)
+    # keyed by item, and when they were last recorded
+    _accesses = {}  # type: ignore
+    _flushed = {}  # type: ignore
+    _access_lock = threading.Lock()
+
+    def __init__(
+        self,
+        directory: str = None,
+        layout: str = None,
+        codec: str = None,
+        max_size: int = None,
+        policy: str = "lru",
+    ):
         """
         Initialise the cache object with the directory
 
@@ -16,59 +290,541 @@ class PDBFileCache(object):
 
         Args:
             directory: The cache directory
+            layout: The directory layout of a new cache (flat or sharded),
+                by default the layout of the existing cache or flat
+            codec: Compress the files written with gzip or zstd
+            max_size: Evict items when the files take more bytes than this
+            policy: Evict the least recently (lru) or frequently (lfu) used
+                items first
 
         """
+        if codec is not None and codec not in codecs:
+            raise RuntimeError("Codec not supported: %s" % codec)
+        if codec == "zstd":
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                raise RuntimeError("Install zstandard to use the zstd codec")
+        if policy not in self.policies:
+            raise RuntimeError("Eviction policy not supported: %s" % policy)
+        self.codec = codec
+        self.max_size = max_size
+        self.policy = policy
 
         # Set the cache directory
-        self.directory = os.path.abspath(
-            directory
-            if directory is not None
-            else os.path.abspath(
-                os.path.expanduser(os.path.join("~", ".cache", "pdb"))
-            )
-        )
+        self.directory = cache_directory(directory)
 
-        # Create the directory if it doesn't exist
-        if not os.path.exists(self.directory):
-            os.mkdir(self.directory)
+        # The database holding the manifest
+        self.database = os.path.join(self.directory, "cache.sqlite")
+        self._connection = None
 
-        # The manifest filename
+        # The manifest filename of older versions of profet
         self.manifest = os.path.join(self.directory, "manifest.txt")
+        if os.path.exists(self.manifest):
+            self._migrate_manifest()
+
+        # Get the directory layout
+        known = self._layouts.get(self.directory)
+        if known is None or (layout is not None and layout != known):
+            known = self._layouts[self.directory] = self._get_layout(layout)
+        self.layout = known
+
+    def _get_layout(self, layout: str = None) -> str:
+        """
+        Get the directory layout of the cache, recording it if it is new
+
+        Args:
+            layout: The requested layout
+
+        Returns:
+            The layout
 
-    def path(self, uniprot_id: str, filetype: str = "cif") -> str:
+        """
+        if layout is not None and layout not in self.layouts:
+            raise RuntimeError("Layout not supported: %s" % layout)
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT value FROM settings WHERE key = 'layout'"
+            ).fetchone()
+            if row is None:
+                # A cache from before layouts were recorded is flat
+                if connection.execute(
+                    "SELECT 1 FROM manifest LIMIT 1"
+                ).fetchone():
+                    row = ("flat",)
+                else:
+                    row = (layout if layout is not None else "flat",)
+                connection.execute(
+                    "INSERT OR IGNORE INTO settings VALUES ('layout', ?)", row
+                )
+        if layout is not None and layout != row[0]:
+            raise RuntimeError(
+                "The cache in %s has the %s layout, migrate it to use %s"
+                % (self.directory, row[0], layout)
+            )
+        return row[0]
+
+    def migrate(self, layout: str):
+        """
+        Move the files in the cache to another directory layout in place
+
+        An interrupted migration can be completed by running it again.
+
+        Args:
+            layout: The new layout (flat or sharded)
+
+        """
+        if layout not in self.layouts:
+            raise RuntimeError("Layout not supported: %s" % layout)
+
+        # Find the files in any layout, in case a migration was interrupted
+        entries = list(self._walk("flat")) + list(self._walk("sharded"))
+
+        # Move the files and update the manifest
+        self.layout = layout
+        with self._transaction() as connection:
+            for entry in entries:
+                identifier, filetype, codec = split_filename(entry.name)
+                filename = self.path(identifier, filetype, codec)
+                if filename != entry.path:
+                    os.makedirs(os.path.dirname(filename), exist_ok=True)
+                    os.replace(entry.path, filename)
+                connection.execute(
+                    "UPDATE manifest SET filename = ? "
+                    "WHERE identifier = ? AND filetype = ?",
+                    (filename, identifier, filetype),
+                )
+            connection.execute(
+                "INSERT OR REPLACE INTO settings VALUES ('layout', ?)",
+                (layout,),
+            )
+        self._layouts[self.directory] = layout
+
+        # Remove the empty shards
+        if layout == "flat":
+            for dirpath, dirnames, filenames in os.walk(
+                self.directory, topdown=False
+            ):
+                if dirpath != self.directory and not os.listdir(dirpath):
+                    os.rmdir(dirpath)
+        self.refresh()
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Connect to the database, creating the tables if they don't exist
+
+        The tables are checked on every connection, so the cache keeps
+        working if its directory is removed and created again.
+
+        Returns:
+            The connection
+
+        """
+        connection = connect(self.database)
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version < self.schema_version:
+            self._create_manifest(connection)
+        return connection
+
+    def _create_manifest(self, connection: sqlite3.Connection):
+        """
+        Create the manifest table if it doesn't exist
+
+        Args:
+            connection: The connection to the database
+
+        """
+        with transaction(connection):
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS manifest ("
+                "identifier TEXT, "
+                "filetype TEXT, "
+                "fileorigin TEXT, "
+                "filename TEXT, "
+                "PRIMARY KEY (identifier, filetype))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS manifest_fileorigin "
+                "ON manifest (fileorigin)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS manifest_filetype "
+                "ON manifest (filetype)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS settings ("
+                "key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+            # Add the columns missing from the manifests of older versions
+            columns = [
+                row[1]
+                for row in connection.execute("PRAGMA table_info(manifest)")
+            ]
+            for column, kind in [
+                ("codec", "TEXT"),
+                ("size", "INTEGER"),
+                ("disk_size", "INTEGER"),
+                ("accessed", "REAL"),
+                ("hits", "INTEGER DEFAULT 0"),
+            ]:
+                if column not in columns:
+                    connection.execute(
+                        "ALTER TABLE manifest ADD COLUMN %s %s" % (column, kind)
+                    )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS manifest_accessed "
+                "ON manifest (accessed)"
+            )
+            connection.execute("PRAGMA user_version = %d" % self.schema_version)
+
+    def _migrate_manifest(self):
+        """
+        Move the entries of a JSON manifest file into the manifest table
+
+        """
+        with open(self.manifest) as infile:
+            data = json.load(infile)
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO manifest "
+                "(identifier, filetype, fileorigin, filename) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        uniprot_id.lower(),
+                        entry["filetype"],
+                        entry["fileorigin"],
+                        entry["filename"],
+                    )
+                    for uniprot_id, entry in data.items()
+                ],
+            )
+
+        # Another process may have migrated it at the same time
+        try:
+            os.replace(self.manifest, self.manifest + ".migrated")
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def _transaction(self, write: bool = True):
+        """
+        Get a connection to the database in a transaction
+
+        Within a batch the batch connection is used, otherwise the
+        transaction is committed when the block exits.
+
+        Args:
+            write: Whether the transaction writes to the database
+
+        """
+        if self._connection is not None:
+            yield self._connection
+        else:
+            with closing(self._connect()) as connection:
+                with transaction(connection, write):
+                    yield connection
+
+    @contextmanager
+    def batch(self):
+        """
+        Commit the manifest updates made within the block in one transaction
+
+        The cache object must not be shared between threads in the block,
+        and other processes can't update the cache until the block exits.
+
+        """
+        with closing(self._connect()) as connection, transaction(connection):
+            self._connection = connection
+            try:
+                yield self
+            finally:
+                self._connection = None
+
+    def path(
+        self, uniprot_id: str, filetype: str = "cif", codec: str = None
+    ) -> str:
         """
         Get the proposed path
 
         Args:
             uniprot_id: The uniprot id
             filetype: Either pdb or cif
+            codec: The compression codec, if any
 
         Returns:
             The absolute path
 
         """
         assert filetype in ["pdb", "cif"]
-        return os.path.join(self.directory, uniprot_id.lower()) + "." + filetype
+        identifier = uniprot_id.lower()
+        if self.layout == "sharded":
+            shard = hashlib.md5(identifier.encode()).hexdigest()
+            directory = os.path.join(self.directory, shard[0:2], shard[2:4])
+        else:
+            directory = self.directory
+        return (
+            os.path.join(directory, identifier)
+            + "."
+            + filetype
+            + (codecs[codec] if codec is not None else "")
+        )
 
-    def find(self, uniprot_id: str) -> list:
+    def _walk(self, layout: str):
+        """
+        Iterate through the structure files in a directory layout
+
+        Args:
+            layout: The directory layout
+
+        Yields:
+            The directory entries of the files
+
+        """
+
+        def scan(directory, depth):
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if depth > 0:
+                            if len(entry.name) == 2 and entry.is_dir():
+                                yield from scan(entry.path, depth - 1)
+                        elif split_filename(entry.name) is not None:
+                            yield entry
+            except FileNotFoundError:
+                return
+
+        yield from scan(self.directory, 2 if layout == "sharded" else 0)
+
+    def _index(self) -> dict:
+        """
+        Get the index of the files in the cache directory, building it if
+        necessary
+
+        Returns:
+            The dictionary of {filetype: filename} keyed by identifier
+
+        """
+        index = self._indices.get(self.directory)
+        if index is None:
+            with self._index_lock:
+                index = self._indices.get(self.directory)
+                if index is None:
+                    index = self._indices[self.directory] = self._scan()
+        return index
+
+    def _scan(self) -> dict:
+        """
+        List the files in the cache directory
+
+        Returns:
+            The dictionary of {filetype: filename} keyed by identifier
+
+        """
+        index = {}  # type: ignore
+        for entry in self._walk(self.layout):
+            identifier, filetype, codec = split_filename(entry.name)
+            index.setdefault(identifier, {})[filetype] = entry.path
+        return index
+
+    def refresh(self):
+        """
+        Rebuild the index of the files in the cache directory
+
+        """
+        with self._index_lock:
+            self._indices[self.directory] = self._scan()
+
+    def find(self, uniprot_id: str, filetype: str = None) -> list:
         """
         Find all items matching the uniprot_id
 
         Args:
             uniprot_id: The uniprot id
+            filetype: Only find items of this file type
 
         Returns:
             The list of matching items
 
         """
+        index = self._index()
+        identifier = uniprot_id.lower()
+        filetypes = ["pdb", "cif"] if filetype is None else [filetype]
+
+        # Look for files added by other processes before reporting a miss,
+        # only with the codecs this cache object could have written
+        entry = index.get(identifier, {})
+        if not any(ftype in entry for ftype in filetypes):
+            for ftype in filetypes:
+                for codec in dict.fromkeys([None, self.codec]):
+                    filename = self.path(uniprot_id, ftype, codec)
+                    if os.path.exists(filename):
+                        index.setdefault(identifier, {})[ftype] = filename
+                        break
+            entry = index.get(identifier, {})
         return [
-            filename
-            for filename in [
-                self.path(uniprot_id, filetype) for filetype in ["pdb", "cif"]
-            ]
-            if os.path.exists(filename)
+            entry[ftype]
+            for ftype in ["pdb", "cif"]
+            if ftype in entry and filetype in [None, ftype]
         ]
 
+    def forget(self, uniprot_id: str, filetype: str = None):
+        """
+        Remove an item from the in memory index, such as one whose file was
+        removed by another process
+
+        Args:
+            uniprot_id: The uniprot id
+            filetype: Only forget the item of this file type
+
+        """
+        index = self._index()
+        identifier = uniprot_id.lower()
+        entry = index.get(identifier, {})
+        for ftype in ["pdb", "cif"]:
+            if filetype in [None, ftype]:
+                entry.pop(ftype, None)
+        if not entry:
+            index.pop(identifier, None)
+
+    def get(self, uniprot_id: str, filetype: str = None):
+        """
+        Get the full path to the item if it is in the cache
+
+        Args:
+            uniprot_id: The uniprot id
+            filetype: Only get an item of this file type
+
+        Returns:
+            The absolute path to the item, or None if it is not in the cache
+
+        """
+        filenames = self.find(uniprot_id, filetype)
+        if not filenames:
+            return None
+
+        # Record the access for eviction
+        if self.max_size is not None:
+            self._record_access(
+                uniprot_id.lower(), split_filename(filenames[0])[1]
+            )
+        return filenames[0]
+
+    def _record_access(self, identifier: str, filetype: str):
+        """
+        Record an access to an item
+
+        The accesses are held in memory and written to the manifest in
+        batches, so a lookup doesn't usually touch the database.
+
+        """
+        now = time.time()
+        with self._access_lock:
+            accesses = self._accesses.setdefault(self.directory, {})
+            _, hits = accesses.get((identifier, filetype), (0, 0))
+            accesses[identifier, filetype] = (now, hits + 1)
+            flushed = self._flushed.setdefault(self.directory, now)
+            due = (
+                len(accesses) >= self.access_batch
+                or now - flushed >= self.access_interval
+            )
+        if due:
+            with self._transaction() as connection:
+                self._flush_accesses(connection)
+
+    def _flush_accesses(self, connection: sqlite3.Connection):
+        """
+        Write the accesses held in memory to the manifest
+
+        Args:
+            connection: The connection in the current transaction
+
+        """
+        self._write_accesses(self.directory, connection)
+
+    @classmethod
+    def _write_accesses(cls, directory: str, connection: sqlite3.Connection):
+        """
+        Write the accesses held in memory for a cache directory
+
+        Args:
+            directory: The cache directory
+            connection: The connection to the database of the directory
+
+        """
+        with cls._access_lock:
+            accesses = cls._accesses.pop(directory, {})
+            cls._flushed[directory] = time.time()
+        if not accesses:
+            return
+        connection.executemany(
+            "UPDATE manifest SET accessed = MAX(COALESCE(accessed, 0), ?), "
+            "hits = hits + ? WHERE identifier = ? AND filetype = ?",
+            [
+                (accessed, hits, identifier, filetype)
+                for (identifier, filetype), (accessed, hits) in accesses.items()
+            ],
+        )
+
+    @classmethod
+    def _flush_all(cls):
+        """
+        Write the accesses held in memory for all the cache directories
+
+        This is called at exit.
+
+        """
+        for directory in list(cls._accesses):
+            database = os.path.join(directory, "cache.sqlite")
+            with suppress(sqlite3.Error), closing(
+                connect(database)
+            ) as connection, transaction(connection):
+                cls._write_accesses(directory, connection)
+
+    def resolve(self, uniprot_id: str, filetype: str = None):
+        """
+        Find the cached item of a uniprot id without the network
+
+        Structures from the PDB are cached under an identifier made from the
+        uniprot id and the PDB id, which is looked up in the manifest. If
+        there are several the most recently used is returned.
+
+        Args:
+            uniprot_id: The uniprot id
+            filetype: Only find an item of this file type
+
+        Returns:
+            The tuple (identifier, filename), or None if it is not in the
+            cache
+
+        """
+        filename = self.get(uniprot_id, filetype)
+        if filename is not None:
+            return uniprot_id, filename
+
+        # The identifiers start with the uniprot id and an underscore, and
+        # a backtick sorts just after an underscore, so this is a range scan
+        # of the primary key
+        sql = (
+            "SELECT DISTINCT identifier, accessed FROM manifest "
+            "WHERE identifier >= ? AND identifier < ?"
+        )
+        values = [uniprot_id.lower() + "_", uniprot_id.lower() + "`"]
+        if filetype is not None:
+            sql += " AND filetype = ?"
+            values.append(filetype)
+        sql += " ORDER BY accessed DESC"
+        with self._transaction(write=False) as connection:
+            rows = connection.execute(sql, values).fetchall()
+
+        # Skip the entries whose files have gone
+        for identifier, _ in rows:
+            filename = self.get(identifier, filetype)
+            if filename is not None:
+                return identifier, filename
+        return None
+
     def __contains__(self, uniprot_id: str) -> bool:
         """
         Check if the filename is in the cache
@@ -93,14 +849,19 @@ class PDBFileCache(object):
             The absolute path to the item
 
         """
-        if uniprot_id not in self:
+        filename = self.get(uniprot_id)
+        if filename is None:
             raise RuntimeError("%s not in cache" % uniprot_id)
-        return self.find(uniprot_id)[0]
+        return filename
 
     def __setitem__(self, uniprot_id: str, item: tuple):
         """
         Write the file into the cache
 
+        The file data can also be given already compressed, as (The file
+        origin, The file type, The file data, The codec), in which case it
+        is written as is if the codec is that of the cache.
+
         Args:
             uniprot_id: The uniprot id
             item: (The file origin, The file type, The file data)
@@ -108,62 +869,767 @@ class PDBFileCache(object):
         """
 
         # Get the item components
-        fileorigin, filetype, filedata = item
+        fileorigin, filetype, filedata = item[:3]
+        codec = item[3] if len(item) > 3 else None
+        if isinstance(filedata, str):
+            filedata = filedata.encode()
+        self.write(uniprot_id, fileorigin, filetype, [filedata], codec)
+
+    def write(
+        self,
+        uniprot_id: str,
+        fileorigin: str,
+        filetype: str,
+        chunks,
+        codec: str = None,
+    ) -> "CachedFile":
+        """
+        Write the file into the cache a chunk at a time
+
+        Only one chunk is held in memory at a time, so a download can be
+        streamed straight into the cache.
+
+        Args:
+            uniprot_id: The uniprot id
+            fileorigin: The file origin
+            filetype: The file type
+            chunks: An iterable of the file data as bytes
+            codec: The codec the chunks are compressed with, if any
+
+        Returns:
+            A handle on the cached file
+
+        """
 
         # Get the filename
-        filename = self.path(uniprot_id, filetype)
+        filename = self.path(uniprot_id, filetype, self.codec)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
 
-        # Bytes or string
-        if isinstance(filedata, (bytes, bytearray)):
-            mode = "wb"
-        else:
-            mode = "w"
+        # Write compressed chunks as they are if the codec is that of the
+        # cache and the size can be read from the gzip trailer
+        opener = open_file
+        if codec == "gzip" and self.codec == "gzip":
+            opener = open
+        elif codec is not None:
+            chunks = decompress_chunks(chunks, codec)
 
-        # Write the file
-        with open(filename, mode) as outfile:
-            outfile.write(filedata)
+        # Write to a temporary file and rename it so that other processes
+        # never see a partly written file. The temporary name keeps the codec
+        # extension but is not that of a structure, so it is never indexed
+        extension = codecs[self.codec] if self.codec is not None else ""
+        tmpname = "%s.tmp%d-%d%s" % (
+            filename[: len(filename) - len(extension)],
+            os.getpid(),
+            threading.get_ident(),
+            extension,
+        )
+        try:
+            size = 0
+            tail = b""
+            with opener(tmpname, "wb") as outfile:
+                for chunk in chunks:
+                    outfile.write(chunk)
+                    size += len(chunk)
+                    tail = (tail + chunk)[-4:]
+            if opener is open:
+                size = int.from_bytes(tail, "little")
+            disk_size = os.path.getsize(tmpname)
+            os.replace(tmpname, filename)
+        except BaseException:
+            # The file may not have been created
+            with suppress(FileNotFoundError):
+                os.remove(tmpname)
+            raise
+
+        # Remove the file if it was previously stored with another codec
+        entry = self._index().setdefault(uniprot_id.lower(), {})
+        if entry.get(filetype, filename) != filename:
+            try:
+                os.remove(entry[filetype])
+            except FileNotFoundError:
+                pass
+
+        # Add the file to the index
+        entry[filetype] = filename
 
         # Update the manifest
-        self._update_manifest(uniprot_id, fileorigin, filetype, filename)
+        total = self._update_manifest(
+            uniprot_id,
+            fileorigin,
+            filetype,
+            filename,
+            self.codec,
+            size,
+            disk_size,
+        )
+
+        # Make room for the file, without evicting it
+        if self.max_size is not None and total > self.max_size:
+            self.prune(keep=(uniprot_id.lower(), filetype))
+        return CachedFile(filename, size, fileorigin, filetype)
+
+    def handle(self, uniprot_id: str, filetype: str = None):
+        """
+        Get a lazy handle on an item without reading it
+
+        Args:
+            uniprot_id: The uniprot id
+            filetype: Only get an item of this file type
+
+        Returns:
+            The handle, or None if the item is not in the cache
+
+        """
+        filenames = self.find(uniprot_id, filetype)
+        if not filenames:
+            return None
+        filename = filenames[0]
+
+        # The file may have been removed by another process
+        if not os.path.exists(filename):
+            self.forget(uniprot_id, split_filename(filename)[1])
+            return None
+
+        # Items added by other processes may not be in the manifest
+        for entry in self.query(identifier=uniprot_id):
+            if entry["filename"] == filename:
+                return CachedFile(
+                    filename,
+                    entry["size"],
+                    entry["fileorigin"],
+                    entry["filetype"],
+                )
+        return CachedFile(filename, filetype=split_filename(filename)[1])
+
+    def open(self, uniprot_id: str, filetype: str = None, mode: str = "rt"):
+        """
+        Open an item for reading, decompressing it if necessary
+
+        Args:
+            uniprot_id: The uniprot id
+            filetype: Only open an item of this file type
+            mode: The mode to open the item with (rt or rb)
+
+        Returns:
+            The file object
+
+        """
+        filename = self.get(uniprot_id, filetype)
+        if filename is not None:
+            try:
+                return open_file(filename, mode)
+            except FileNotFoundError:
+                # The file was removed by another process
+                self.forget(uniprot_id, split_filename(filename)[1])
+        raise RuntimeError("%s not in cache" % uniprot_id)
+
+    def query(
+        self,
+        identifier: str = None,
+        fileorigin: str = None,
+        filetype: str = None,
+    ) -> list:
+        """
+        Query the manifest
+
+        Args:
+            identifier: Only return entries with this identifier
+            fileorigin: Only return entries from this origin
+            filetype: Only return entries of this file type
+
+        Returns:
+            The list of matching manifest entries as dictionaries
+
+        """
+        columns = [
+            "identifier",
+            "filetype",
+            "fileorigin",
+            "filename",
+            "codec",
+            "size",
+        ]
+        conditions = []
+        values = []
+        for column, value in [
+            ("identifier", identifier.lower() if identifier else None),
+            ("fileorigin", fileorigin),
+            ("filetype", filetype),
+        ]:
+            if value is not None:
+                conditions.append("%s = ?" % column)
+                values.append(value)
+        sql = "SELECT %s FROM manifest" % ", ".join(columns)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        with self._transaction(write=False) as connection:
+            rows = connection.execute(sql, values).fetchall()
+        return [dict(zip(columns, row)) for row in rows]
 
     def items(self):
         """
         Iterate through the items in the cache
 
+        The directory is scanned lazily, one shard at a time.
+
+        Yields:
+            The (identifier, filename) of each item
+
         """
-        for filename in os.listdir(self.directory):
-            if filename.endswith(".cif") or filename.endswith(".pdb"):
-                uniprot_id, filetype = os.path.splitext(filename)
-                yield uniprot_id, self.path(uniprot_id, filetype[1:])
+        for entry in self._walk(self.layout):
+            yield split_filename(entry.name)[0], entry.path
 
     def _update_manifest(
-        self, uniprot_id: str, fileorigin: str, filetype: str, filename: str
-    ):
+        self,
+        uniprot_id: str,
+        fileorigin: str,
+        filetype: str,
+        filename: str,
+        codec: str = None,
+        size: int = None,
+        disk_size: int = None,
+    ) -> int:
         """
-        Update the manifest file
+        Update the manifest
 
         Args:
             uniprot_id: The uniprot id
             fileorigin: The file origin
             filetype: The file type
             filename: The filename
+            codec: The compression codec, if any
+            size: The uncompressed size of the file in bytes
+            disk_size: The size of the file on disk in bytes
+
+        Returns:
+            The total size of the files in the cache in bytes
 
         """
 
-        # Read the current manifest
-        if os.path.exists(self.manifest):
-            with open(self.manifest) as infile:
-                data = json.load(infile)
-        else:
-            data = {}
-
-        # Update the data
-        data[uniprot_id] = {
-            "fileorigin": fileorigin,
-            "filetype": filetype,
-            "filename": filename,
-        }
-
-        # Write the data to the file
-        with open(self.manifest, "w") as outfile:
-            json.dump(data, outfile)
+        identifier = uniprot_id.lower()
+        with self._transaction() as connection:
+            self._flush_accesses(connection)
+            total = self._total(connection)
+            row = connection.execute(
+                "SELECT disk_size FROM manifest "
+                "WHERE identifier = ? AND filetype = ?",
+                (identifier, filetype),
+            ).fetchone()
+            if row is not None:
+                total -= row[0] or 0
+            total += disk_size or 0
+            connection.execute(
+                "INSERT OR REPLACE INTO manifest "
+                "(identifier, filetype, fileorigin, filename, codec, size, "
+                "disk_size, accessed, hits) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)",
+                (
+                    identifier,
+                    filetype,
+                    fileorigin,
+                    filename,
+                    codec,
+                    size,
+                    disk_size,
+                    time.time(),
+                ),
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO settings VALUES ('total', ?)", (total,)
+            )
+        return total
+
+    def _total(self, connection: sqlite3.Connection) -> int:
+        """
+        Get the total size of the files in the cache
+
+        Args:
+            connection: The connection in the current transaction
+
+        Returns:
+            The total size in bytes
+
+        """
+        row = connection.execute(
+            "SELECT value FROM settings WHERE key = 'total'"
+        ).fetchone()
+        if row is not None:
+            return int(row[0])
+        return connection.execute(
+            "SELECT COALESCE(SUM(disk_size), 0) FROM manifest"
+        ).fetchone()[0]
+
+    def size(self) -> int:
+        """
+        Returns:
+            The total size of the files in the cache in bytes
+
+        """
+        with self._transaction(write=False) as connection:
+            return self._total(connection)
+
+    def prune(
+        self, max_size: int = None, policy: str = None, keep: tuple = None
+    ) -> list:
+        """
+        Evict items until the files in the cache take at most max_size bytes
+
+        The items are evicted in bulk, down to a fraction of max_size given
+        by low_water. Entries without a recorded size are measured first and
+        the total size is recounted, so this also repairs the manifest after
+        files were removed by hand.
+
+        Args:
+            max_size: The maximum size in bytes, by default that of the cache
+            policy: The eviction policy, by default that of the cache
+            keep: The (identifier, filetype) of an item never to evict, such
+                as the one just written
+
+        Returns:
+            The list of the evicted filenames
+
+        """
+        max_size = self.max_size if max_size is None else max_size
+        policy = self.policy if policy is None else policy
+        if max_size is None:
+            raise RuntimeError("No maximum size to prune the cache to")
+        if policy not in self.policies:
+            raise RuntimeError("Eviction policy not supported: %s" % policy)
+
+        evicted = []
+        with self._transaction() as connection:
+            self._flush_accesses(connection)
+
+            # Measure the files added by older versions
+            missing = []
+            unsized = []
+            for identifier, filetype, filename in connection.execute(
+                "SELECT identifier, filetype, filename FROM manifest "
+                "WHERE disk_size IS NULL"
+            ).fetchall():
+                try:
+                    unsized.append(
+                        (os.path.getsize(filename), identifier, filetype)
+                    )
+                except OSError:
+                    missing.append((identifier, filetype))
+            connection.executemany(
+                "UPDATE manifest SET disk_size = ? "
+                "WHERE identifier = ? AND filetype = ?",
+                unsized,
+            )
+            connection.executemany(
+                "DELETE FROM manifest WHERE identifier = ? AND filetype = ?",
+                missing,
+            )
+
+            # Select the items to evict
+            total = connection.execute(
+                "SELECT COALESCE(SUM(disk_size), 0) FROM manifest"
+            ).fetchone()[0]
+            if total > max_size:
+                target = max_size * self.low_water
+                cursor = connection.execute(
+                    "SELECT identifier, filetype, filename, disk_size "
+                    "FROM manifest ORDER BY %s" % self.policies[policy]
+                )
+                while total > target:
+                    rows = cursor.fetchmany(1000)
+                    if not rows:
+                        break
+                    for identifier, filetype, filename, disk_size in rows:
+                        if total <= target:
+                            break
+                        if (identifier, filetype) == keep:
+                            continue
+                        evicted.append((identifier, filetype, filename))
+                        total -= disk_size
+
+            # Remove the items
+            connection.executemany(
+                "DELETE FROM manifest WHERE identifier = ? AND filetype = ?",
+                [(identifier, filetype) for identifier, filetype, _ in evicted],
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO settings VALUES ('total', ?)", (total,)
+            )
+            for identifier, filetype, filename in evicted:
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+                self.forget(identifier, filetype)
+        return [filename for _, _, filename in evicted]
+
+
+atexit.register(PDBFileCache._flush_all)
+
+
+class CachedFile(object):
+    """
+    A lazy handle on a file in the cache
+
+    Nothing is read until the contents are asked for, so holding many
+    handles costs no more memory than their filenames.
+
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        size: int = None,
+        fileorigin: str = None,
+        filetype: str = None,
+    ):
+        """
+        Initialise the handle
+
+        Args:
+            filename: The absolute path to the file
+            size: The uncompressed size of the file in bytes
+            fileorigin: The database the file came from
+            filetype: The file type
+
+        """
+        self.filename = filename
+        self.size = size
+        self.fileorigin = fileorigin
+        self.filetype = filetype
+
+    def open(self, mode: str = "rt"):
+        """
+        Open the file for reading, decompressing it if necessary
+
+        Args:
+            mode: The mode to open the file with (rt or rb)
+
+        Returns:
+            The file object
+
+        """
+        return open_file(self.filename, mode)
+
+    def read(self) -> str:
+        """
+        Returns:
+            The contents of the file
+
+        """
+        with self.open() as infile:
+            return infile.read()
+
+    def __fspath__(self) -> str:
+        return self.filename
+
+    def __repr__(self) -> str:
+        return "CachedFile(%r, size=%r, fileorigin=%r, filetype=%r)" % (
+            self.filename,
+            self.size,
+            self.fileorigin,
+            self.filetype,
+        )
+
+
+class NegativeCache(object):
+    """
+    A class to remember which databases don't have a structure for an id
+
+    Each entry records when a database was found not to have the structure,
+    and is ignored once it is older than the time to live. The entries are
+    kept in an SQLite database in the cache directory so that they can be
+    shared by processes.
+
+    """
+
+    def __init__(self, directory: str = None, ttl: float = 7 * 24 * 3600):
+        """
+        Initialise the cache object with the directory
+
+        If directory is None then the cache is set to ~/.cache/pdb
+
+        Args:
+            directory: The cache directory
+            ttl: The time to live of an entry in seconds
+
+        """
+        self.directory = cache_directory(directory)
+        self.filename = os.path.join(self.directory, "cache.sqlite")
+        self.ttl = ttl
+        with closing(connect(self.filename)) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS negative ("
+                "uniprot_id TEXT, db TEXT, timestamp REAL, "
+                "PRIMARY KEY (uniprot_id, db))"
+            )
+
+    def missing(self, uniprot_id: str) -> list:
+        """
+        Get the databases known not to have the structure
+
+        Args:
+            uniprot_id: The uniprot id
+
+        Returns:
+            The list of databases with an entry that has not expired
+
+        """
+        with closing(connect(self.filename)) as connection:
+            rows = connection.execute(
+                "SELECT db FROM negative "
+                "WHERE uniprot_id = ? AND timestamp > ? ORDER BY rowid",
+                (uniprot_id.upper(), time.time() - self.ttl),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def add(self, uniprot_id: str, dbs: list):
+        """
+        Record that the databases don't have the structure
+
+        Args:
+            uniprot_id: The uniprot id
+            dbs: The databases that don't have the structure
+
+        """
+        if not dbs:
+            return
+        now = time.time()
+        with closing(connect(self.filename)) as connection, transaction(
+            connection
+        ):
+            connection.executemany(
+                "INSERT OR REPLACE INTO negative VALUES (?, ?, ?)",
+                [(uniprot_id.upper(), db, now) for db in dbs],
+            )
+
+    def remove(self, uniprot_id: str):
+        """
+        Forget the entries for an id
+
+        Args:
+            uniprot_id: The uniprot id
+
+        """
+        with closing(connect(self.filename)) as connection:
+            connection.execute(
+                "DELETE FROM negative WHERE uniprot_id = ?",
+                (uniprot_id.upper(),),
+            )
+
+    def expire(self):
+        """
+        Remove the entries older than the time to live
+
+        """
+        with closing(connect(self.filename)) as connection:
+            connection.execute(
+                "DELETE FROM negative WHERE timestamp <= ?",
+                (time.time() - self.ttl,),
+            )
+
+
+class PDBIdCache(object):
+    """
+    A class to cache the PDB ids matching a uniprot id
+
+    The ids are kept in an SQLite database in the cache directory so that
+    lookups and inserts don't depend on the number of entries.
+
+    """
+
+    # The table of the entries, which is also the name of the value column
+    table = "pdb_ids"
+
+    def __init__(self, directory: str = None, ttl: float = 30 * 24 * 3600):
+        """
+        Initialise the cache object with the directory
+
+        If directory is None then the cache is set to ~/.cache/pdb
+
+        Args:
+            directory: The cache directory
+            ttl: The time to live of an entry in seconds
+
+        """
+        self.directory = directory
+        self.filename = None
+        self.ttl = ttl
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Connect to the database
+
+        The cache directory and the table are created on the first
+        connection, so that making a cache object doesn't touch the disk.
+
+        Returns:
+            The connection
+
+        """
+        if self.filename is None:
+            filename = os.path.join(
+                cache_directory(self.directory), "cache.sqlite"
+            )
+            with closing(connect(filename)) as connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS %s ("
+                    "uniprot_id TEXT PRIMARY KEY, %s TEXT, timestamp REAL)"
+                    % (self.table, self.table)
+                )
+            self.filename = filename
+        return connect(self.filename)
+
+    def get(self, uniprot_id: str):
+        """
+        Get the PDB ids matching the uniprot id
+
+        Args:
+            uniprot_id: The uniprot id
+
+        Returns:
+            The list of PDB ids, or None if the uniprot id is not in the
+            cache or the entry has expired
+
+        """
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                "SELECT %s FROM %s WHERE uniprot_id = ? AND timestamp > ?"
+                % (self.table, self.table),
+                (uniprot_id.upper(), time.time() - self.ttl),
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_many(self, uniprot_ids: list) -> dict:
+        """
+        Get the entries of many uniprot ids with one connection
+
+        Args:
+            uniprot_ids: The uniprot ids
+
+        Returns:
+            The dictionary of the entries which have not expired, keyed by
+            the upper case uniprot id
+
+        """
+        keys = list(
+            dict.fromkeys(uniprot_id.upper() for uniprot_id in uniprot_ids)
+        )
+        entries = {}
+        with closing(self._connect()) as connection:
+            # Stay under the limit on the number of SQL variables
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                rows = connection.execute(
+                    "SELECT uniprot_id, %s FROM %s "
+                    "WHERE uniprot_id IN (%s) AND timestamp > ?"
+                    % (self.table, self.table, ", ".join("?" * len(chunk))),
+                    chunk + [time.time() - self.ttl],
+                )
+                entries.update(
+                    (uniprot_id, json.loads(value))
+                    for uniprot_id, value in rows
+                )
+        return entries
+
+    def __contains__(self, uniprot_id: str) -> bool:
+        """
+        Check if the uniprot id has an entry which has not expired
+
+        Args:
+            uniprot_id: The uniprot id
+
+        Returns:
+            True/False if the uniprot id is in the cache
+
+        """
+        return self.get(uniprot_id) is not None
+
+    def __setitem__(self, uniprot_id: str, pdb_ids: list):
+        """
+        Set the PDB ids matching the uniprot id
+
+        Args:
+            uniprot_id: The uniprot id
+            pdb_ids: The list of PDB ids
+
+        """
+        self.update({uniprot_id: pdb_ids})
+
+    def update(self, mapping: dict):
+        """
+        Set the PDB ids of many uniprot ids in one transaction
+
+        Args:
+            mapping: The lists of PDB ids keyed by uniprot id
+
+        """
+        now = time.time()
+        with closing(self._connect()) as connection, transaction(connection):
+            connection.executemany(
+                "INSERT OR REPLACE INTO %s VALUES (?, ?, ?)" % self.table,
+                [
+                    (uniprot_id.upper(), self.encode(pdb_ids), now)
+                    for uniprot_id, pdb_ids in mapping.items()
+                ],
+            )
+
+    def encode(self, value) -> str:
+        """
+        Encode the value of an entry as JSON
+
+        Args:
+            value: The value
+
+        Returns:
+            The JSON
+
+        """
+        return json.dumps(list(value))
+
+    def expire(self):
+        """
+        Remove the entries older than the time to live
+
+        """
+        with closing(self._connect()) as connection:
+            connection.execute(
+                "DELETE FROM %s WHERE timestamp <= ?" % self.table,
+                (time.time() - self.ttl,),
+            )
+
+
+class SignalPeptideCache(PDBIdCache):
+    """
+    A class to cache the signal peptides of a uniprot id
+
+    The signal peptides are kept as lists of (start, end) residue numbers in
+    the same SQLite database as the PDB ids, so a rerun needs no requests to
+    UniProt.
+
+    """
+
+    table = "signal_peptides"
+
+
+class PredictionCache(PDBIdCache):
+    """
+    A class to cache the AlphaFold model of a uniprot id
+
+    The model is kept as the dictionary of the URLs of its cif and pdb files
+    and its version, as resolved from the AlphaFold API.
+
+    """
+
+    table = "predictions"
+
+    def encode(self, value) -> str:
+        """
+        Encode the value of an entry as JSON
+
+        Args:
+            value: The dictionary of the model
+
+        Returns:
+            The JSON
+
+        """
+        return json.dumps(value)
@@ -1,16 +1,376 @@
+from .cache import SignalPeptideCache, codecs, open_file
+from .mmcif import AtomSiteReader
+from .session import PooledSession
+from contextlib import closing, contextmanager
+import io
+import mmap
+import re
 import requests
 import xml.etree.ElementTree as ET
 import os
 
 
+# The characters str.strip removes from ASCII text, and the null padding of
+# the columns past the end of a line
+_blank_chars = b"\x00 \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f"
+
+# The format of a UniProt accession, without an isoform
+_accession = re.compile(
+    r"[OPQ][0-9][A-Z0-9]{3}[0-9]|[A-NR-Z][0-9]([A-Z][A-Z0-9]{2}[0-9]){1,2}"
+)
+
+# A signal peptide feature in the TSV format, the positions can be unknown
+# or have a less or greater than modifier
+_signal = re.compile(r"SIGNAL\s+<?(\d+|\?)\.\.>?(\d+|\?)")
+
+
+@contextmanager
+def _read_buffer(filename: str):
+    """
+    Read a file into a buffer, memory mapping it if it is not compressed
+
+    """
+    if any(filename.endswith(extension) for extension in codecs.values()):
+        with open_file(filename, "rb") as infile:
+            yield infile.read()
+    elif os.path.getsize(filename) == 0:
+        yield b""
+    else:
+        with open(filename, "rb") as infile:
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+
+def _pdb_keep_runs(
+    data,
+    signal_list: list,
+    signal_peptides: bool,
+    hydrogens: bool,
+    water: bool,
+    hetatoms: bool,
+):
+    """
+    Find the lines of a pdb file to keep in one vectorised pass
+
+    The lines are filtered exactly as the line by line engine does. Files
+    the column offsets can't be computed for in bytes, and lines whose
+    residue number can't be parsed, are left to that engine.
+
+    Args:
+        data: The contents of the pdb file
+        signal_list: list of signal peptides to remove
+        signal_peptides: Whether to remove signal peptides
+        hydrogens: Whether to remove hydrogens
+        water: Whether to remove water molecules
+        hetatoms: Whether to remove HETATM entries
+
+    Returns:
+        The list of (start, end) byte offsets of the runs of lines to keep,
+        or None if the file must be filtered line by line
+
+    """
+    # Numpy is only imported when it is used as it is slow to import
+    import numpy as np
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if len(buf) == 0:
+        return []
+
+    # Only ASCII text with unix newlines splits into the same lines
+    if buf.max() >= 128 or data.find(b"\r") >= 0 or data.find(b"\0") >= 0:
+        return None
+
+    # Find the lines, including their newlines
+    ends = np.flatnonzero(buf == 10) + 1
+    if len(ends) == 0 or ends[-1] != len(buf):
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate(([0], ends[:-1]))
+    blank = np.zeros(256, dtype=bool)
+    blank[list(_blank_chars)] = True
+    lengths = ends - starts
+
+    # Gather the columns used by the filters from every line at once, with
+    # nulls past the end of the line
+    width = 26
+    padded = np.concatenate((buf, np.zeros(width, dtype=np.uint8)))
+    columns = padded[starts[:, None] + np.arange(width)]
+    columns[np.arange(width) >= lengths[:, None]] = 0
+
+    def startswith(prefix):
+        prefix = np.frombuffer(prefix, dtype=np.uint8)
+        return (columns[:, : len(prefix)] == prefix).all(1)
+
+    atom = startswith(b"ATOM")
+    hetatm = startswith(b"HETATM")
+    remove = np.zeros(len(starts), dtype=bool)
+
+    # Parse the residue numbers of the ATOM lines from columns 22-26
+    rows = np.flatnonzero(atom)
+    chars = columns[rows, 22:26]
+    digits = (chars >= ord("0")) & (chars <= ord("9"))
+    ndigits = digits.sum(1)
+    first = np.argmax(digits, 1)
+    last = 3 - np.argmax(digits[:, ::-1], 1)
+    simple = (
+        (digits | blank[chars]).all(1)
+        & (ndigits > 0)
+        & (ndigits == last - first + 1)
+    )
+    residues = np.zeros(len(rows), dtype=np.int64)
+    for i in range(4):
+        residues = np.where(
+            digits[:, i], residues * 10 + chars[:, i] - ord("0"), residues
+        )
+
+    # Numbers with a sign are rare, parse them as the line by line engine
+    for i in np.flatnonzero(~simple):
+        start = starts[rows[i]]
+        field = bytes(data[start + 22 : min(start + 26, ends[rows[i]])])
+        try:
+            residues[i] = int(field.decode().strip())
+        except ValueError:
+            return None
+
+    if signal_peptides:
+        signal = np.zeros(len(rows), dtype=bool)
+        for start, end in signal_list:
+            signal |= (residues >= start) & (residues <= end)
+        remove[rows[signal]] = True
+
+    # The atom name in columns 12-16 starts with H once stripped
+    if hydrogens:
+        name = columns[:, 12:16]
+        filled = ~blank[name]
+        first_char = name[np.arange(len(name)), np.argmax(filled, 1)]
+        remove |= (atom | hetatm) & filled.any(1) & (first_char == ord("H"))
+
+    # The residue name in columns 17-20 is HOH
+    if water:
+        remove |= (atom | hetatm) & (
+            columns[:, 17:20] == np.frombuffer(b"HOH", dtype=np.uint8)
+        ).all(1)
+
+    if hetatoms:
+        remove |= hetatm
+
+    # Merge consecutive lines to keep into runs
+    change = np.diff(np.concatenate(([0], (~remove).astype(np.int8), [0])))
+    run_starts = np.flatnonzero(change == 1)
+    run_ends = np.flatnonzero(change == -1)
+    return list(zip(starts[run_starts].tolist(), ends[run_ends - 1].tolist()))
+
+
+def _atom_site_filter(
+    columns: dict,
+    signal_list: list,
+    signal_peptides: bool,
+    hydrogens: bool,
+    water: bool,
+    hetatoms: bool,
+):
+    """
+    Make a function telling whether to remove a row of an _atom_site loop
+
+    The filters needing columns the loop doesn't have are skipped.
+
+    Args:
+        columns: The column indices of the loop keyed by name
+        signal_list: list of signal peptides to remove
+        signal_peptides: Whether to remove signal peptides
+        hydrogens: Whether to remove hydrogens
+        water: Whether to remove water molecules
+        hetatoms: Whether to remove HETATM entries
+
+    Returns:
+        The function of the list of values of a row
+
+    """
+    checks = []
+    seq_id = columns.get("label_seq_id", columns.get("auth_seq_id"))
+    if signal_peptides and signal_list and seq_id is not None:
+
+        def is_signal(row, i=seq_id):
+            # Non polymer atoms have no sequence number
+            return row[i].lstrip("-").isdigit() and any(
+                start <= int(row[i]) <= end for start, end in signal_list
+            )
+
+        checks.append(is_signal)
+    if hydrogens and "type_symbol" in columns:
+        i = columns["type_symbol"]
+        checks.append(lambda row, i=i: row[i] in ("H", "D"))
+    if water and "label_comp_id" in columns:
+        i = columns["label_comp_id"]
+        checks.append(lambda row, i=i: row[i] in ("HOH", "DOD"))
+    if hetatoms and "group_PDB" in columns:
+        i = columns["group_PDB"]
+        checks.append(lambda row, i=i: row[i] == "HETATM")
+
+    # Incomplete rows are kept as they are
+    ncolumns = len(columns)
+    return lambda row: len(row) >= ncolumns and any(
+        check(row) for check in checks
+    )
+
+
+def _filter_lines(
+    lines,
+    file_extension: str,
+    signal_list: list,
+    signal_peptides: bool,
+    hydrogens: bool,
+    water: bool,
+    hetatoms: bool,
+):
+    """
+    Filter the lines of a pdb or cif file one at a time
+
+    Args:
+        lines: An iterable of the lines of the file
+        file_extension: The file format, pdb or cif
+        signal_list: list of signal peptides to remove
+        signal_peptides: Whether to remove signal peptides
+        hydrogens: Whether to remove hydrogens
+        water: Whether to remove water molecules
+        hetatoms: Whether to remove HETATM entries
+
+    Yields:
+        The text to keep
+
+    """
+
+    def is_hydrogen_pdb(line: str) -> bool:
+        return (line.startswith("ATOM") or line.startswith("HETATM")) and line[
+            12:16
+        ].strip().startswith("H")
+
+    def is_water_pdb(line: str) -> bool:
+        return (line.startswith("ATOM") or line.startswith("HETATM")) and line[
+            17:20
+        ].strip() == "HOH"
+
+    def is_hetatm_pdb(line: str) -> bool:
+        return line.startswith("HETATM")
+
+    # Filter the rows of the _atom_site loops of cif files
+    if file_extension == "cif":
+        reader = AtomSiteReader(lines)
+        columns = None
+        for text, row in reader:
+            if row is not None:
+                if reader.columns is not columns:
+                    columns = reader.columns
+                    remove = _atom_site_filter(
+                        columns,
+                        signal_list,
+                        signal_peptides,
+                        hydrogens,
+                        water,
+                        hetatoms,
+                    )
+                if remove(row):
+                    continue
+            yield text
+        return
+
+    # Filter the lines of pdb files
+    for line in lines:
+        # 22-26 to check for amino acid number/ residue number
+        residue_position = (
+            int(line[22:26].strip()) if line.startswith("ATOM") else None
+        )
+
+        if signal_peptides and residue_position is not None:
+            if any(
+                start <= residue_position <= end for start, end in signal_list
+            ):
+                continue
+        if hydrogens and is_hydrogen_pdb(line):
+            continue
+        if water and is_water_pdb(line):
+            continue
+        if hetatoms and is_hetatm_pdb(line):
+            continue
+        yield line
+
+
+def _filter_data(
+    data,
+    file_extension: str,
+    signal_list: list,
+    signal_peptides: bool,
+    hydrogens: bool,
+    water: bool,
+    hetatoms: bool,
+    engine: str,
+):
+    """
+    Filter a pdb or cif structure held in memory
+
+    Yields:
+        The chunks to keep, str if the data is str and bytes otherwise
+
+    """
+    text = isinstance(data, str)
+    flags = (signal_list, signal_peptides, hydrogens, water, hetatoms)
+
+    # Filter pdb files in bulk if possible
+    if file_extension == "pdb" and engine == "numpy":
+        buf = data.encode() if text else data
+        if not isinstance(buf, (bytes, bytearray, mmap.mmap)):
+            buf = bytes(buf)
+        runs = _pdb_keep_runs(buf, *flags)
+        if runs is not None:
+            for start, end in runs:
+                chunk = bytes(buf[start:end])
+                yield chunk.decode() if text else chunk
+            return
+
+    # Split the lines as a file opened in text mode would
+    lines = io.StringIO(data if text else bytes(data).decode(), newline=None)
+    for chunk in _filter_lines(lines, file_extension, *flags):
+        yield chunk if text else chunk.encode()
+
+
 class Cleaver:
     """
     Class, identifying signal peptides based on UniProt and cleaving pdb/cif file to remove signal peptides of the
     protein structure.
     """
 
-    def __init__(self):
-        pass
+    # The number of accessions to ask UniProt about in one request
+    batch_size = 200
+
+    def __init__(
+        self,
+        session: requests.Session = None,
+        signal_cache: SignalPeptideCache = None,
+    ):
+        """
+        Initialise the cleaver
+
+        Args:
+            session: The HTTP session to query UniProt with
+            signal_cache: The cache of the signal peptides
+
+        """
+        self.session = session
+        self.signal_cache = signal_cache
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        Returns:
+            The HTTP session, created on first use unless one was given
+
+        """
+        if self._session is None:
+            self._session = PooledSession()
+        return self._session
+
+    @session.setter
+    def session(self, session: requests.Session):
+        self._session = session
 
     def signal_residuenumbers_requester(self, uniprot_id: str) -> list:
         """
@@ -24,38 +384,201 @@ class Cleaver:
             by UniProt.
 
         """
+        if self.signal_cache is not None:
+            signal_list = self.signal_cache.get(uniprot_id)
+            if signal_list is not None:
+                return [tuple(signal) for signal in signal_list]
+
         # UniProt link to parse from
-        url = f"https://rest.uniprot.org/uniprotkb/{uniprot_id}.xml"
-        # Send an HTTP GET request to the UniProt website
-        response = requests.get(url)
-        # Parse the XML content from the response
-        root = ET.fromstring(response.content)
+        url = self.make_url(uniprot_id)
+        # Send an HTTP GET request to the UniProt website, and parse the
+        # response as it arrives, closing the connection once done
+        with closing(self.session.get(url, stream=True)) as response:
+            response.raw.decode_content = True
+            signal_list = self.parse_signal_peptides(uniprot_id, response.raw)
+        if self.signal_cache is not None:
+            self.signal_cache[uniprot_id] = signal_list
+        return signal_list
+
+    def signal_peptides_batch(self, uniprot_ids: list) -> dict:
+        """
+        Collects the signal peptides of many uniprot ids
+
+        The ids not in the cache are searched for on UniProt in batches of
+        batch_size accessions per request, asking for the signal peptide
+        features only. The ids the search doesn't return, such as isoforms
+        or secondary accessions, are requested one at a time.
+
+        Args:
+            uniprot_ids: IDs from Uniprot
+
+        Returns:
+            The lists of the pairs of starting and end position of the
+            signal peptides keyed by id
+
+        """
+        cached = (
+            self.signal_cache.get_many(uniprot_ids)
+            if self.signal_cache is not None
+            else {}
+        )
+        signals = {}
+        missing = []
+        for uniprot_id in dict.fromkeys(uniprot_ids):
+            if uniprot_id.upper() in cached:
+                signals[uniprot_id] = [
+                    tuple(signal) for signal in cached[uniprot_id.upper()]
+                ]
+            elif _accession.fullmatch(uniprot_id.upper()):
+                missing.append(uniprot_id)
+
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i : i + self.batch_size]
+            found = self.request_signal_peptides(batch)
+            if self.signal_cache is not None:
+                self.signal_cache.update(found)
+            for uniprot_id in batch:
+                if uniprot_id.upper() in found:
+                    signals[uniprot_id] = found[uniprot_id.upper()]
+
+        # Fall back on the entries of the ids the search can't find
+        for uniprot_id in dict.fromkeys(uniprot_ids):
+            if uniprot_id not in signals:
+                signals[uniprot_id] = self.signal_residuenumbers_requester(
+                    uniprot_id
+                )
+        return signals
+
+    def request_signal_peptides(self, accessions: list) -> dict:
+        """
+        Search UniProt for the signal peptides of some accessions
+
+        Args:
+            accessions: The UniProt accessions
+
+        Returns:
+            The lists of the pairs of starting and end position of the
+            signal peptides keyed by the primary accessions found
+
+        """
+        response = self.session.get(
+            "https://rest.uniprot.org/uniprotkb/stream",
+            params={
+                "query": " OR ".join(
+                    "accession:%s" % accession for accession in accessions
+                ),
+                "fields": "accession,ft_signal",
+                "format": "tsv",
+            },
+        )
+        response.raise_for_status()
+        return self.parse_signal_tsv(response.text)
+
+    def parse_signal_tsv(self, content: str) -> dict:
+        """
+        Parse the signal peptide positions from a UniProt TSV search result
+
+        Args:
+            content: The TSV with the accession and ft_signal columns
+
+        Returns:
+            The lists of the pairs of starting and end position of the
+            signal peptides keyed by accession
+
+        """
+        signals = {}
+        for line in content.splitlines()[1:]:
+            accession, _, features = line.partition("\t")
+            if accession:
+                # Skip the signal peptides without known positions
+                signals[accession.upper()] = [
+                    (int(start), int(end))
+                    for start, end in _signal.findall(features)
+                    if start != "?" and end != "?"
+                ]
+        return signals
+
+    def make_url(self, uniprot_id: str) -> str:
+        """
+        Make the URL of the UniProt entry
+
+        Args:
+            uniprot_id: ID from Uniprot
+
+        Returns:
+            The URL of the UniProt XML entry
+
+        """
+        return f"https://rest.uniprot.org/uniprotkb/{uniprot_id}.xml"
+
+    def parse_signal_peptides(self, uniprot_id: str, content) -> list:
+        """
+        Parse the signal peptide positions from a UniProt XML entry
+
+        The entry is parsed incrementally and each element is discarded once
+        read, so the whole tree is never built. Parsing stops at the end of
+        the features, which come before the evidence and the sequence.
+
+        Args:
+            uniprot_id: ID from Uniprot
+            content: The XML content of the UniProt entry, as bytes or a
+                file object to read it from
+
+        Returns:
+            The list of the pairs of starting and end position of the signal
+            peptides.
+
+        """
+        if isinstance(content, (bytes, bytearray)):
+            content = io.BytesIO(content)
+
+        def name(element):
+            # Strip the namespace
+            return element.tag.rpartition("}")[2]
+
         # List to store multiple signal peptides
         signal_peptides = []
 
-        # Find the signal peptide starting and end positions
-        for child in root:
-            for grandchild in child:
-                if grandchild.attrib.get("type") == "signal peptide":
-                    if (
-                        grandchild[0][0].attrib.get("position")
-                        and grandchild[0][1].attrib.get("position") is not None
-                    ):
-                        start_position = int(
-                            str(grandchild[0][0].attrib.get("position"))
-                        )
-                        end_position = int(
-                            str(grandchild[0][1].attrib.get("position"))
-                        )
-                        signal_peptides.append((start_position, end_position))
-                    else:
-                        print(uniprot_id + "has no signal peptide")
+        depth = 0
+        entry = None
+        in_features = False
+        for event, element in ET.iterparse(content, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 2:
+                    entry = element
+
+                # The features are listed together, stop after the last one
+                elif depth == 3:
+                    if name(element) == "feature":
+                        in_features = True
+                    elif in_features:
+                        break
+                continue
+            depth -= 1
+            if depth != 2:
+                continue
+
+            # Find the signal peptide starting and end positions
+            if element.get("type") == "signal peptide":
+                positions = {
+                    name(child): child.get("position")
+                    for location in element
+                    for child in location
+                }
+                if positions.get("begin") and positions.get("end") is not None:
+                    signal_peptides.append(
+                        (int(positions["begin"]), int(positions["end"]))
+                    )
                 else:
-                    None
+                    print(uniprot_id + "has no signal peptide")
+
+            # Discard the elements of the entry already read
+            entry.clear()
         return signal_peptides
 
+    @staticmethod
     def remove_nonmain(
-        self,
         input_file: str,
         signal_list: list = None,
         signal_peptides=True,
@@ -63,21 +586,36 @@ class Cleaver:
         water=True,
         hetatoms=True,
         output_filename: str = None,
+        engine: str = "numpy",
     ):
         """
         Removes signal peptides, hydrogens, water molecules, and HETATM entries based on the flags passed.
 
+        The numpy engine filters pdb files in one vectorised pass over the
+        whole file, which is memory mapped, and falls back to filtering line
+        by line as the python engine does for files it can't handle. The
+        output is the same with either engine.
+
+        In cif files only the rows of the _atom_site loop are filtered, on
+        the values of their type_symbol, label_comp_id, group_PDB and
+        label_seq_id columns wherever they are in the loop. Everything else
+        is copied as it is.
+
         Args:
-            input_file: Path to the input file (pdb or cif)
+            input_file: Path to the input file (pdb or cif, optionally
+                compressed)
             signal_list: list of signal peptides to remove
             signal_peptides: Whether to remove signal peptides (default: True)
             hydrogens: Whether to remove hydrogens (default: True)
             water: Whether to remove water molecules (default: True)
             hetatoms: Whether to remove HETATM entries (default: True)
             output_filename: Optional custom output filename.
+            engine: The engine to filter pdb files with (numpy or python)
         Returns:
-            None
+            The output filename
         """
+        if engine not in ["numpy", "python"]:
+            raise ValueError("Unsupported engine: %s" % engine)
 
         # Ensure signal_list is a list or an empty list if None
         if signal_list is None:
@@ -100,89 +638,114 @@ class Cleaver:
         if hetatoms:
             filename_parts.append("nohetatm")
 
+        # Strip the extension of a compressed input file
+        plain_file = input_file
+        for extension in codecs.values():
+            if input_file.endswith(extension):
+                plain_file = input_file[: -len(extension)]
+
         # Set default output filename if none is provided
         if output_filename is None:
-            base_name, ext = os.path.splitext(input_file)
+            base_name, ext = os.path.splitext(plain_file)
             filename_suffix = (
                 "_".join(filename_parts) if filename_parts else "unmodified"
             )
             output_filename = f"{base_name}_{filename_suffix}{ext}"
 
-        def is_hydrogen_pdb(line: str) -> bool:
-            return (
-                line.startswith("ATOM") or line.startswith("HETATM")
-            ) and line[12:16].strip().startswith("H")
+        # Determine file format based on extension
+        file_extension = plain_file.split(".")[-1].lower()
 
-        def is_hydrogen_cif(line: str) -> bool:
-            return line.startswith("ATOM") and " H" in line
+        # Filter pdb files in bulk if possible
+        if file_extension == "pdb" and engine == "numpy":
+            with _read_buffer(input_file) as data:
+                runs = _pdb_keep_runs(
+                    data,
+                    signal_list,
+                    signal_peptides,
+                    hydrogens,
+                    water,
+                    hetatoms,
+                )
+                if runs is not None:
+                    with open(output_filename, "wb") as output_f:
+                        for start, end in runs:
+                            output_f.write(data[start:end])
+                    print(f"File saved as {output_filename}")
+                    return output_filename
 
-        def is_water_pdb(line: str) -> bool:
-            return (
-                line.startswith("ATOM") or line.startswith("HETATM")
-            ) and line[17:20].strip() == "HOH"
+        if file_extension not in ["pdb", "cif"]:
+            raise ValueError(
+                "Unsupported file format. Only pdb and cif are supported."
+            )
 
-        def is_water_cif(line: str) -> bool:
-            return (
-                line.startswith("ATOM") or line.startswith("HETATM")
-            ) and "HOH" in line
+        with open_file(input_file, "rt") as input_f:
+            with open(output_filename, "w") as output_f:
+                output_f.writelines(
+                    _filter_lines(
+                        input_f,
+                        file_extension,
+                        signal_list,
+                        signal_peptides,
+                        hydrogens,
+                        water,
+                        hetatoms,
+                    )
+                )
 
-        def is_hetatm_pdb(line: str) -> bool:
-            return line.startswith("HETATM")
+        print(f"File saved as {output_filename}")
+        return output_filename
 
-        def is_hetatm_cif(line: str) -> bool:
-            return "HETATM" in line
+    @staticmethod
+    def remove_nonmain_data(
+        data,
+        filetype: str,
+        signal_list: list = None,
+        signal_peptides=True,
+        hydrogens=True,
+        water=True,
+        hetatoms=True,
+        engine: str = "numpy",
+        stream: bool = False,
+    ):
+        """
+        Removes signal peptides, hydrogens, water molecules, and HETATM
+        entries from a structure in memory, without reading or writing files.
 
-        # Determine file format based on extension
-        file_extension = input_file.split(".")[-1].lower()
+        The structure is filtered exactly as remove_nonmain filters a file.
 
-        with open(input_file, "r") as input_f:
-            with open(output_filename, "w") as output_f:
-                for line in input_f:
-                    if file_extension == "pdb":
-                        # 22-26 to check for amino acid number/ residue number
-                        residue_position = (
-                            int(line[22:26].strip())
-                            if line.startswith("ATOM")
-                            else None
-                        )
-
-                        if signal_peptides and residue_position is not None:
-                            if any(
-                                start <= residue_position <= end
-                                for start, end in signal_list
-                            ):
-                                continue
-                        if hydrogens and is_hydrogen_pdb(line):
-                            continue
-                        if water and is_water_pdb(line):
-                            continue
-                        if hetatoms and is_hetatm_pdb(line):
-                            continue
-                        output_f.write(line)
-
-                    elif file_extension == "cif":
-                        columns = line.split()
-                        residue_number = (
-                            int(columns[8]) if len(columns) > 8 else None
-                        )
-
-                        if signal_peptides:
-                            if any(
-                                start <= residue_number <= end
-                                for start, end in signal_list
-                            ):
-                                continue
-                        if hydrogens and is_hydrogen_cif(line):
-                            continue
-                        if water and is_water_cif(line):
-                            continue
-                        if hetatoms and is_hetatm_cif(line):
-                            continue
-                        output_f.write(line)
-
-                    else:
-                        raise ValueError(
-                            "Unsupported file format. Only pdb and cif are supported."
-                        )
+        Args:
+            data: The structure as str, bytes or any other buffer
+            filetype: The file format, pdb or cif
+            signal_list: list of signal peptides to remove
+            signal_peptides: Whether to remove signal peptides (default: True)
+            hydrogens: Whether to remove hydrogens (default: True)
+            water: Whether to remove water molecules (default: True)
+            hetatoms: Whether to remove HETATM entries (default: True)
+            engine: The engine to filter pdb files with (numpy or python)
+            stream: Return an iterator over chunks of the result
 
-        print(f"File saved as {output_filename}")
+        Returns:
+            The filtered structure, str if the data is str and bytes
+            otherwise, or an iterator over its chunks if streaming
+
+        """
+        if engine not in ["numpy", "python"]:
+            raise ValueError("Unsupported engine: %s" % engine)
+        if filetype not in ["pdb", "cif"]:
+            raise ValueError(
+                "Unsupported file format. Only pdb and cif are supported."
+            )
+
+        chunks = _filter_data(
+            data,
+            filetype,
+            signal_list if signal_list is not None else [],
+            signal_peptides,
+            hydrogens,
+            water,
+            hetatoms,
+            engine,
+        )
+        if stream:
+            return chunks
+        return ("" if isinstance(data, str) else b"").join(chunks)
@@ -1,7 +1,8 @@
 from argparse import ArgumentParser
-from profet import Fetcher
+from profet.cache import PDBFileCache
 from typing import List
 import os
+import sys
 
 
 __all__ = ["main"]
@@ -15,6 +16,18 @@ def get_description():
     return "Download a PDB file"
 
 
+def parse_size(value: str) -> int:
+    """
+    Parse a size in bytes with an optional K, M, G or T suffix
+
+    """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    value = value.strip().upper().rstrip("B")
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
 def get_parser(parser: ArgumentParser = None) -> ArgumentParser:
     """
     Get the parser for the command line
@@ -56,25 +69,266 @@ def get_parser(parser: ArgumentParser = None) -> ArgumentParser:
         dest="save_directory",
         help="The directory to save the PDB files.",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        dest="jobs",
+        help="The number of files to download in parallel",
+    )
+    parser.add_argument(
+        "--sifts",
+        type=str,
+        default=None,
+        dest="sifts",
+        help="A SIFTS pdb_chain_uniprot TSV file to look up PDB ids offline",
+    )
+    parser.add_argument(
+        "--alphafold_accessions",
+        type=str,
+        default=None,
+        dest="alphafold_accessions",
+        help="An AlphaFold accession_ids.csv file to look up models offline",
+    )
+    parser.add_argument(
+        "--compress",
+        type=str,
+        default=None,
+        dest="codec",
+        choices=["gzip", "zstd"],
+        help="Compress the saved files",
+    )
+    parser.add_argument(
+        "--refresh",
+        default=False,
+        action="store_true",
+        dest="refresh",
+        help="Search again for ids previously found to be unavailable",
+    )
+    parser.add_argument(
+        "--max_cache_size",
+        type=parse_size,
+        default=None,
+        dest="max_cache_size",
+        help="Evict files to keep the cache under this size, e.g. 10G",
+    )
+    parser.add_argument(
+        "--cache_policy",
+        type=str,
+        default="lru",
+        dest="cache_policy",
+        choices=list(PDBFileCache.policies),
+        help="Evict the least recently or least frequently used files first",
+    )
+    parser.add_argument(
+        "--render",
+        default=False,
+        action="store_true",
+        dest="render",
+        help="Render the AlphaFold entry page if the API has no file URL",
+    )
 
     return parser
 
 
+def get_cache_parser(parser: ArgumentParser = None) -> ArgumentParser:
+    """
+    Get the parser for the cache command line
+
+    """
+
+    # Initialise the parser
+    if parser is None:
+        parser = ArgumentParser(
+            prog="profet cache", description="Manage the cache of PDB files"
+        )
+
+    # Add the commands
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    migrate = subparsers.add_parser(
+        "migrate", help="Move the cached files to another directory layout"
+    )
+    migrate.add_argument(
+        "--layout",
+        type=str,
+        required=True,
+        dest="layout",
+        choices=PDBFileCache.layouts,
+        help="The directory layout to move the files to",
+    )
+
+    prune = subparsers.add_parser(
+        "prune", help="Evict files to bring the cache under a size"
+    )
+    prune.add_argument(
+        "--max_size",
+        type=parse_size,
+        required=True,
+        dest="max_size",
+        help="The size to bring the cache under, e.g. 10G",
+    )
+    prune.add_argument(
+        "--policy",
+        type=str,
+        default="lru",
+        dest="policy",
+        choices=list(PDBFileCache.policies),
+        help="Evict the least recently or least frequently used files first",
+    )
+
+    # Add the arguments common to all commands
+    for subparser in [migrate, prune]:
+        subparser.add_argument(
+            "--save_directory",
+            type=str,
+            default=os.path.abspath(os.path.expanduser("~/.cache/pdb")),
+            dest="save_directory",
+            help="The directory of the PDB files.",
+        )
+
+    return parser
+
+
+def get_clean_parser(parser: ArgumentParser = None) -> ArgumentParser:
+    """
+    Get the parser for the clean command line
+
+    """
+
+    # Initialise the parser
+    if parser is None:
+        parser = ArgumentParser(
+            prog="profet clean",
+            description="Remove signal peptides, hydrogens, water and HETATM "
+            "entries from cached PDB files",
+        )
+
+    parser.add_argument(
+        "uniprot_id",
+        type=str,
+        nargs="+",
+        help="The uniprot_ids of the cached files to clean",
+    )
+    parser.add_argument(
+        "--save_directory",
+        type=str,
+        default=os.path.abspath(os.path.expanduser("~/.cache/pdb")),
+        dest="save_directory",
+        help="The directory of the PDB files.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        dest="jobs",
+        help="The number of files to clean in parallel, by default the "
+        "number of CPUs",
+    )
+    for name, help in [
+        ("signal_peptides", "signal peptides"),
+        ("hydrogens", "hydrogens"),
+        ("water", "water molecules"),
+        ("hetatoms", "HETATM entries"),
+    ]:
+        parser.add_argument(
+            "--keep_" + name,
+            default=True,
+            action="store_false",
+            dest=name,
+            help="Don't remove the %s" % help,
+        )
+
+    return parser
+
+
+def clean_main_impl(args):
+    """
+    Clean some cached PDB files
+
+    """
+    from profet import Fetcher
+
+    fetcher = Fetcher(save_directory=args.save_directory)
+    results, errors = fetcher.remove_files(
+        args.uniprot_id,
+        signal_peptides=args.signal_peptides,
+        hydrogens=args.hydrogens,
+        water=args.water,
+        hetatoms=args.hetatoms,
+        max_workers=args.jobs,
+    )
+
+    # Report the outcome for each id in the order given
+    for identifier in dict.fromkeys(args.uniprot_id):
+        if identifier in results:
+            print("Cleaned %s to '%s'" % (identifier, results[identifier]))
+        else:
+            print("Failed to clean %s: %s" % (identifier, errors[identifier]))
+    if errors:
+        raise SystemExit(1)
+
+
+def cache_main_impl(args):
+    """
+    Manage the cache of PDB files
+
+    """
+    cache = PDBFileCache(directory=args.save_directory)
+    if args.command == "migrate":
+        cache.migrate(args.layout)
+        print("Moved '%s' to the %s layout" % (cache.directory, args.layout))
+    elif args.command == "prune":
+        evicted = cache.prune(args.max_size, args.policy)
+        print(
+            "Evicted %d files from '%s', %d bytes remain"
+            % (len(evicted), cache.directory, cache.size())
+        )
+
+
 def main_impl(args):
     """
     Use profet to download some PDB files
 
     """
+    # The fetcher and its dependencies are only imported by the commands
+    # using it, so the others start quickly
+    from profet import Fetcher
 
     # Create the fetcher
-    fetcher = Fetcher(main_db=args.main_db, save_directory=args.save_directory)
+    fetcher = Fetcher(
+        main_db=args.main_db,
+        save_directory=args.save_directory,
+        sifts=args.sifts,
+        alphafold_accessions=args.alphafold_accessions,
+        codec=args.codec,
+        max_cache_size=args.max_cache_size,
+        cache_policy=args.cache_policy,
+        render=args.render,
+    )
 
-    # Get the file
-    for identifier in args.uniprot_id:
-        filename, filedata = fetcher.get_file(
-            identifier, filetype=args.filetype, filesave=True, db=args.main_db
-        )
-        print("Saved %s to '%s'" % (identifier, filename))
+    # Get the files
+    results, errors = fetcher.get_files(
+        args.uniprot_id,
+        filetype=args.filetype,
+        filesave=True,
+        db=args.main_db,
+        max_workers=args.jobs,
+        refresh=args.refresh,
+        stream=True,
+    )
+
+    # Report the outcome for each id in the order given
+    for identifier in dict.fromkeys(args.uniprot_id):
+        if identifier in results:
+            filename, filedata = results[identifier]
+            print("Saved %s to '%s'" % (identifier, filename))
+        else:
+            print("Failed to get %s: %s" % (identifier, errors[identifier]))
+    if errors:
+        raise SystemExit(1)
 
 
 def main(args: List[str] = None):
@@ -82,4 +336,11 @@ def main(args: List[str] = None):
     Create a main configuration
 
     """
-    main_impl(get_parser().parse_args(args=args))
+    if args is None:
+        args = sys.argv[1:]
+    if args[:1] == ["cache"]:
+        cache_main_impl(get_cache_parser().parse_args(args=args[1:]))
+    elif args[:1] == ["clean"]:
+        clean_main_impl(get_clean_parser().parse_args(args=args[1:]))
+    else:
+        main_impl(get_parser().parse_args(args=args))
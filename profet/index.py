@@ -0,0 +1,328 @@
+"""Compact on disk indices to answer lookups without the network"""
+
+import abc
+import csv
+import gzip
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+
+class SortedIndex(abc.ABC):
+    """
+    A base class for a sorted file of fixed size records
+
+    Each record starts with a fixed size key. The file is memory mapped on
+    the first lookup and binary searched, so a lookup only touches a few
+    pages and the table never has to be loaded into memory.
+
+    """
+
+    # The file header, the size of the record key and of the whole record
+    magic = b""
+    key_size = 0
+    record_size = 0
+
+    # The number of records to sort in memory at a time when building
+    chunk_size = 1000000
+
+    def __init__(self, filename: str):
+        """
+        Initialise the index from an index file
+
+        The file is opened on the first lookup.
+
+        Args:
+            filename: The index filename
+
+        """
+        self.filename = os.path.abspath(filename)
+        self._mmap = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    @abc.abstractmethod
+    def build(cls, source_filename: str, filename: str) -> "SortedIndex":
+        """
+        Build the index from a source file
+
+        Args:
+            source_filename: The source file
+            filename: The index filename to write
+
+        Returns:
+            The index
+
+        """
+
+    @classmethod
+    def from_file(cls, filename: str) -> "SortedIndex":
+        """
+        Open an index, building it first if the file is a source file
+
+        The index built from a source file is written next to it and is only
+        rebuilt if the source file is newer.
+
+        Args:
+            filename: The index filename or the source filename
+
+        Returns:
+            The index
+
+        """
+        with open(filename, "rb") as infile:
+            if infile.read(len(cls.magic)) == cls.magic:
+                return cls(filename)
+        index_filename = filename + ".idx"
+        if not os.path.exists(index_filename) or os.path.getmtime(
+            index_filename
+        ) < os.path.getmtime(filename):
+            return cls.build(filename, index_filename)
+        return cls(index_filename)
+
+    @classmethod
+    def write(cls, records, filename: str):
+        """
+        Sort the records and write them to the index file
+
+        The records are sorted in chunks which are merged on disk, so memory
+        use is bounded by the chunk size. Duplicate records are dropped.
+
+        Args:
+            records: An iterable of records as bytes
+            filename: The index filename to write
+
+        """
+        directory = os.path.dirname(os.path.abspath(filename))
+        with tempfile.TemporaryDirectory(dir=directory) as tmpdir:
+            # Write the sorted runs
+            runs = []
+            chunk = []
+            for record in records:
+                chunk.append(record)
+                if len(chunk) == cls.chunk_size:
+                    runs.append(cls._write_run(chunk, tmpdir, len(runs)))
+                    chunk = []
+            if chunk or not runs:
+                runs.append(cls._write_run(chunk, tmpdir, len(runs)))
+
+            # Merge the runs into a temporary file so a partial index is
+            # never opened
+            infiles = [open(run, "rb") for run in runs]
+            try:
+                with open(filename + ".tmp", "wb") as outfile:
+                    outfile.write(cls.magic)
+                    previous = None
+                    for record in heapq.merge(
+                        *[cls._read_run(infile) for infile in infiles]
+                    ):
+                        if record != previous:
+                            outfile.write(record)
+                        previous = record
+            finally:
+                for infile in infiles:
+                    infile.close()
+        os.replace(filename + ".tmp", filename)
+
+    @classmethod
+    def _write_run(cls, chunk: list, directory: str, number: int) -> str:
+        """
+        Write a sorted run of records to a temporary file
+
+        """
+        filename = os.path.join(directory, "run%d" % number)
+        with open(filename, "wb") as outfile:
+            outfile.write(b"".join(sorted(chunk)))
+        return filename
+
+    @classmethod
+    def _read_run(cls, infile):
+        """
+        Iterate through the records of a sorted run
+
+        """
+        while True:
+            record = infile.read(cls.record_size)
+            if not record:
+                return
+            yield record
+
+    def _open(self) -> mmap.mmap:
+        """
+        Memory map the index file
+
+        """
+        if self._mmap is not None:
+            return self._mmap
+        with self._lock:
+            if self._mmap is None:
+                with open(self.filename, "rb") as infile:
+                    if infile.read(len(self.magic)) != self.magic:
+                        raise RuntimeError(
+                            "%s is not a %s file"
+                            % (self.filename, type(self).__name__)
+                        )
+
+                    # An empty file can't be memory mapped
+                    if os.path.getsize(self.filename) > len(self.magic):
+                        self._mmap = mmap.mmap(
+                            infile.fileno(), 0, access=mmap.ACCESS_READ
+                        )
+                    else:
+                        self._mmap = self.magic  # type: ignore
+        return self._mmap
+
+    def __len__(self) -> int:
+        """
+        Returns:
+            The number of records
+
+        """
+        return (len(self._open()) - len(self.magic)) // self.record_size
+
+    def _record(self, i: int) -> bytes:
+        """
+        Get the ith record
+
+        """
+        start = len(self.magic) + i * self.record_size
+        return self._open()[start : start + self.record_size]
+
+    def find(self, key: bytes) -> list:
+        """
+        Find the records with the key
+
+        Args:
+            key: The key
+
+        Returns:
+            The list of matching records in sorted order
+
+        """
+        if len(key) != self.key_size:
+            return []
+
+        # Binary search for the first record with the key
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[: self.key_size] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # The records with the key are contiguous
+        records = []
+        while lo < len(self):
+            record = self._record(lo)
+            if record[: self.key_size] != key:
+                break
+            records.append(record)
+            lo += 1
+        return records
+
+    def close(self):
+        """
+        Close the memory map
+
+        """
+        with self._lock:
+            if isinstance(self._mmap, mmap.mmap):
+                self._mmap.close()
+            self._mmap = None
+
+
+class AlphafoldIndex(SortedIndex):
+    """
+    A class to look up the AlphaFold models of a uniprot id without the
+    network
+
+    The index is built once from the AlphaFold accession_ids.csv file,
+    https://ftp.ebi.ac.uk/pub/databases/alphafold/accession_ids.csv, and
+    holds the fragment number and the model version of each entry.
+
+    """
+
+    magic = b"PROFET-AFDB-1\n"
+    key_size = 10
+    record = struct.Struct(">10sHB")
+    record_size = record.size
+
+    @classmethod
+    def build(cls, source_filename: str, filename: str) -> "AlphafoldIndex":
+        """
+        Build the index from an AlphaFold accession_ids.csv file
+
+        Args:
+            source_filename: The CSV file, optionally gzipped
+            filename: The index filename to write
+
+        Returns:
+            The index
+
+        """
+
+        def records(infile):
+            # The columns are the uniprot id, the first and last residues,
+            # the AlphaFold id (AF-<uniprot id>-F<fragment>) and the version
+            for row in csv.reader(infile):
+                if len(row) < 5 or not row[4].strip().isdigit():
+                    continue
+                uniprot_id = row[0].strip().upper().encode("ascii")
+                fragment = int(row[3].strip().rsplit("-F", 1)[1])
+                yield cls.record.pack(
+                    uniprot_id.ljust(cls.key_size),
+                    fragment,
+                    int(row[4]),
+                )
+
+        opener = gzip.open if source_filename.endswith(".gz") else open
+        with opener(source_filename, "rt", encoding="iso-8859-1") as infile:
+            cls.write(records(infile), filename)
+        return cls(filename)
+
+    def get(self, uniprot_id: str) -> list:
+        """
+        Get the AlphaFold models of the uniprot id
+
+        Args:
+            uniprot_id: The uniprot id
+
+        Returns:
+            The sorted list of (fragment, version) tuples, empty if there are
+            none
+
+        """
+        key = uniprot_id.upper().encode("ascii").ljust(self.key_size)
+        return [self.record.unpack(record)[1:] for record in self.find(key)]
+
+    def __contains__(self, uniprot_id: str) -> bool:
+        """
+        Check if the uniprot id has an AlphaFold model
+
+        Args:
+            uniprot_id: The uniprot id
+
+        Returns:
+            True/False if the uniprot id is in the index
+
+        """
+        return len(self.get(uniprot_id)) > 0
+
+    def latest_version(self, uniprot_id: str, fragment: int = 1):
+        """
+        Get the latest model version of a fragment
+
+        Args:
+            uniprot_id: The uniprot id
+            fragment: The fragment number
+
+        Returns:
+            The model version, or None if there is no model
+
+        """
+        versions = [v for f, v in self.get(uniprot_id) if f == fragment]
+        return max(versions) if versions else None
@@ -0,0 +1,124 @@
+"""A streaming reader of the _atom_site loop of mmCIF files"""
+
+import re
+
+# A quoted value ends at a quote followed by whitespace, otherwise a value is
+# anything up to the next whitespace
+_token = re.compile(r"""'(.*?)'(?=\s|$)|"(.*?)"(?=\s|$)|(\S+)""")
+
+# The reserved words which end a loop
+_reserved = ("_", "loop_", "data_", "save_", "global_", "stop_")
+
+
+def tokenize(line: str) -> list:
+    """
+    Split a line of an mmCIF file into values
+
+    Args:
+        line: The line
+
+    Returns:
+        The list of values, without their quotes
+
+    """
+    if "'" not in line and '"' not in line:
+        return line.split()
+    return [
+        next(group for group in match.groups() if group is not None)
+        for match in _token.finditer(line)
+    ]
+
+
+class AtomSiteReader:
+    """
+    Iterate through the lines of an mmCIF file, splitting the rows of the
+    _atom_site loop into values
+
+    The loop header is parsed once into the column indices, and only the
+    rows of the loop are tokenised. Everything else is passed through as it
+    is, so writing out the text of every item reproduces the file.
+
+    """
+
+    category = "_atom_site."
+
+    def __init__(self, lines):
+        """
+        Initialise the reader
+
+        Args:
+            lines: An iterable of the lines of the file
+
+        """
+        self.lines = lines
+
+        # The column indices of the current _atom_site loop keyed by name
+        self.columns = None
+
+    def __iter__(self):
+        """
+        Yields:
+            The tuple (text, row) where row is the list of the values of an
+            _atom_site row, spanning one or more lines of text, or None for
+            the other lines
+
+        """
+        header = None
+        in_loop = False
+        text = []
+        row = []  # type: ignore
+        lines = iter(self.lines)
+        for line in lines:
+            stripped = line.lstrip()
+            keyword = stripped[:7].lower()
+
+            # Collect the names of the columns of a loop
+            if header is not None:
+                if stripped.startswith("_"):
+                    header.append(stripped.split()[0])
+                    yield line, None
+                    continue
+                if header and header[0].startswith(self.category):
+                    self.columns = {
+                        name[len(self.category) :]: i
+                        for i, name in enumerate(header)
+                    }
+                    in_loop = True
+                header = None
+
+            # A loop ends at the next data item, loop or block
+            if keyword.startswith(_reserved):
+                if text:
+                    yield "".join(text), row
+                    text, row = [], []
+                in_loop = False
+                if keyword.startswith("loop_"):
+                    header = []
+                yield line, None
+                continue
+
+            if not in_loop or not stripped or stripped.startswith("#"):
+                yield line, None
+                continue
+
+            # A text field runs to the next line starting with a semicolon
+            if line.startswith(";"):
+                text.append(line)
+                value = [line[1:]]
+                for line in lines:
+                    text.append(line)
+                    if line.startswith(";"):
+                        break
+                    value.append(line)
+                row.append("".join(value).rstrip("\n"))
+            else:
+                text.append(line)
+                row.extend(tokenize(line))
+
+            # A row can span several lines
+            if len(row) >= len(self.columns):
+                yield "".join(text), row
+                text, row = [], []
+
+        if text:
+            yield "".join(text), row
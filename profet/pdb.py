@@ -1,5 +1,11 @@
-from urllib.request import urlretrieve
-from rcsbsearchapi import TextQuery
+from .cache import PDBIdCache, decompress_chunks
+from .session import PooledSession
+from .sifts import SIFTSIndex
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import gzip
+import re
+import requests
 
 
 class PDB_DB:
@@ -8,14 +14,47 @@ class PDB_DB:
 
     """
 
-    def __init__(self):
+    # The RCSB search API endpoint
+    search_url = "https://search.rcsb.org/rcsbsearch/v2/query"
+
+    # The size of the chunks of a streamed download
+    chunk_size = 1 << 16
+
+    def __init__(
+        self,
+        session: requests.Session = None,
+        id_cache: PDBIdCache = None,
+        sifts_index: SIFTSIndex = None,
+    ):
         """
         Initialise the PDB data base class
 
+        Args:
+            session: The HTTP session to download files with
+            id_cache: The cache of PDB ids to consult before searching
+            sifts_index: A local SIFTS index to use instead of searching
+
         """
-        pass
+        self.session = session
+        self.id_cache = id_cache
+        self.sifts_index = sifts_index
         # self.return_type = ReturnType.ENTRY
-        self.results = []
+        self.results = {}  # type: ignore
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        Returns:
+            The HTTP session, created on first use unless one was given
+
+        """
+        if self._session is None:
+            self._session = PooledSession()
+        return self._session
+
+    @session.setter
+    def session(self, session: requests.Session):
+        self._session = session
 
     def uniprot_id_to_pdb_id(self, uniprot_id: str):
         """
@@ -28,11 +67,128 @@ class PDB_DB:
             The PDB id
 
         """
-        query = TextQuery(value=uniprot_id)
-        for result in query():
-            return result
+        pdb_ids = self.uniprot_id_to_pdb_ids(uniprot_id)
+        return pdb_ids[0] if pdb_ids else None
+
+    def uniprot_id_to_pdb_ids(self, uniprot_id: str) -> list:
+        """
+        Convert a uniprot_id to all the matching pdb_ids
+
+        The local lookups are tried before searching and the PDB ids cache
+        is updated after.
+
+        Args:
+            uniprot_id: The uniprot id of the protein
+
+        Returns:
+            The list of PDB ids
+
+        """
+        pdb_ids = self.local_pdb_ids(uniprot_id)
+        if pdb_ids is not None:
+            return pdb_ids
+        pdb_ids = self.text_search(uniprot_id)
+        if self.id_cache is not None:
+            self.id_cache[uniprot_id] = pdb_ids
+        return pdb_ids
+
+    def local_pdb_ids(self, uniprot_id: str):
+        """
+        Look up the PDB ids matching a uniprot_id without the network
+
+        If there is a SIFTS index then it is the only source of truth and
+        ids in the PDB id format are taken to be PDB ids. Otherwise the PDB
+        ids cache is used.
+
+        Args:
+            uniprot_id: The uniprot id of the protein
+
+        Returns:
+            The list of PDB ids, or None if they are not known locally
+
+        """
+        if self.sifts_index is not None:
+            if re.fullmatch("[0-9][A-Za-z0-9]{3}", uniprot_id):
+                return [uniprot_id.upper()]
+            return self.sifts_index.get(uniprot_id)
+        if self.id_cache is not None:
+            return self.id_cache.get(uniprot_id)
         return None
 
+    def warm_id_cache(self, uniprot_ids: list, max_workers: int = 8):
+        """
+        Search for the PDB ids of the uniprot ids missing from the cache
+
+        Args:
+            uniprot_ids: The uniprot ids
+            max_workers: The number of searches to run in parallel
+
+        """
+        if self.id_cache is None:
+            raise RuntimeError("PDB_DB has no PDB ids cache to warm")
+
+        def search(uniprot_id):
+            return uniprot_id, self.text_search(uniprot_id)
+
+        # Search in parallel and write the results in one transaction
+        missing = [
+            uniprot_id
+            for uniprot_id in dict.fromkeys(uniprot_ids)
+            if self.local_pdb_ids(uniprot_id) is None
+        ]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            self.id_cache.update(dict(executor.map(search, missing)))
+
+    def text_search(self, uniprot_id: str) -> list:
+        """
+        Search the PDB for the entries matching a uniprot_id
+
+        The search is posted on the session, so it shares the connection
+        pool and the timeout of the downloads.
+
+        Args:
+            uniprot_id: The uniprot id of the protein
+
+        Returns:
+            The list of PDB ids
+
+        """
+        response = self.session.post(
+            self.search_url, json=self.search_request(uniprot_id)
+        )
+        response.raise_for_status()
+
+        # The search returns no content if nothing matches
+        if response.status_code == 204:
+            return []
+        return [
+            result["identifier"]
+            for result in response.json().get("result_set", [])
+        ]
+
+    def search_request(self, uniprot_id: str) -> dict:
+        """
+        Make the RCSB search request for the entries matching a uniprot_id
+
+        All the matching entries are requested, not only the first page.
+
+        Args:
+            uniprot_id: The uniprot id of the protein
+
+        Returns:
+            The JSON body of the search request
+
+        """
+        return {
+            "query": {
+                "type": "terminal",
+                "service": "full_text",
+                "parameters": {"value": uniprot_id},
+            },
+            "return_type": "entry",
+            "request_options": {"return_all_hits": True},
+        }
+
     def check_structure(self, uniprot_id: str) -> bool:
         """
         Check if a protein is contained within the PDB
@@ -46,17 +202,20 @@ class PDB_DB:
         """
         pdb_id = self.uniprot_id_to_pdb_id(uniprot_id)
         if pdb_id is not None:
-            self.results = [pdb_id]
+            self.results[uniprot_id.upper()] = pdb_id
             return True
         return False
 
-    def make_url(self, uniprot_id: str, filetype: str = "pdb") -> str:
+    def make_url(
+        self, uniprot_id: str, filetype: str = "pdb", compressed: bool = False
+    ) -> str:
         """
         Make the URL for the protein
 
         Args:
             uniprot_id: The uniprot id of the protein
             filetype: The type of file to download (pdb or cif)
+            compressed: Make the URL of the gzip compressed file
 
         Returns:
             The URL of the file to download
@@ -65,51 +224,113 @@ class PDB_DB:
 
         uniprot_id = uniprot_id.upper()
         url = f"https://files.rcsb.org/download/{uniprot_id}.{filetype}"
+        if compressed:
+            url += ".gz"
         return url
 
     def get_pdb(
         self,
         uniprot_id: str,
         filetype: str = "cif",
+        compressed: bool = False,
+        stream: bool = False,
     ) -> tuple:
         """
         Returns pdb/cif as strings, saves to file if requested
 
+        The files are always transferred gzip compressed.
+
         Args:
             uniprot_id: ID from Uniprot
             filetype: File type to be retrieved: cif, pdb
+            compressed: Return the file gzip compressed, as bytes
+            stream: Return an iterator of the file data as bytes chunks
+                instead, which reads the download as it is consumed
 
         Returns:
             Tuple containing the filename and file from the database
 
         """
 
-        if not self.results:
-            self.results = [self.uniprot_id_to_pdb_id(uniprot_id)]
+        # The results are keyed by id so that concurrent fetches don't
+        # clobber each other
+        key = uniprot_id.upper()
+        if key not in self.results:
+            self.results[key] = self.uniprot_id_to_pdb_id(uniprot_id)
 
         # Try to get the PDB file
-        pdb_id = self.results[0]
+        pdb_id = self.results[key]
 
         try:
-            url = self.make_url(pdb_id, filetype)
-            filename, result = urlretrieve(url)
-            with open(filename) as file:
-                filedata = file.read()
+            filedata = self.download(
+                self.make_url(pdb_id, filetype, compressed=True),
+                compressed,
+                stream,
+            )
         except Exception:
             if filetype == "pdb":
                 filetype = "cif"
             else:
                 filetype = "pdb"
-            url = self.make_url(pdb_id, filetype)
-            filename, result = urlretrieve(url)
-            with open(filename) as file:
-                filedata = file.read()
-
-        # If pdb is not the same then add the pdb id to the uniprot id as the identifier
-        if pdb_id.lower() != uniprot_id.lower():
-            identifier = uniprot_id + "_" + pdb_id
-        else:
-            identifier = uniprot_id
+            filedata = self.download(
+                self.make_url(pdb_id, filetype, compressed=True),
+                compressed,
+                stream,
+            )
 
         # Return the identifier, file type and file contents
-        return identifier, filetype, filedata
+        return self.make_identifier(uniprot_id, pdb_id), filetype, filedata
+
+    def download(
+        self, url: str, compressed: bool = False, stream: bool = False
+    ):
+        """
+        Download a gzip compressed file
+
+        Args:
+            url: The URL of the file
+            compressed: Return the compressed bytes
+            stream: Return an iterator of the bytes chunks instead
+
+        Returns:
+            The compressed bytes, or the decompressed text
+
+        """
+        response = self.session.get(url, stream=True)
+        if stream:
+            try:
+                response.raise_for_status()
+            except Exception:
+                response.close()
+                raise
+            chunks = response.iter_content(self.chunk_size)
+            return chunks if compressed else decompress_chunks(chunks, "gzip")
+
+        with closing(response):
+            response.raise_for_status()
+            if compressed:
+                return response.content
+
+            # Decompress the file as it streams in
+            response.raw.decode_content = True
+            with gzip.GzipFile(fileobj=response.raw) as infile:
+                return infile.read().decode()
+
+    def make_identifier(self, uniprot_id: str, pdb_id: str) -> str:
+        """
+        Make the identifier under which the file is cached
+
+        If pdb is not the same then add the pdb id to the uniprot id as the
+        identifier
+
+        Args:
+            uniprot_id: The uniprot id of the protein
+            pdb_id: The PDB id of the structure
+
+        Returns:
+            The identifier
+
+        """
+        if pdb_id.lower() != uniprot_id.lower():
+            return uniprot_id + "_" + pdb_id
+        return uniprot_id
@@ -1,8 +1,26 @@
 from .alphafold import Alphafold_DB
 from .pdb import PDB_DB
-from .cache import PDBFileCache
+from .index import AlphafoldIndex
+from .cache import (
+    PDBFileCache,
+    NegativeCache,
+    PDBIdCache,
+    PredictionCache,
+    SignalPeptideCache,
+    decompress,
+    open_file,
+)
 from .cleaver import Cleaver
+from .session import PooledSession
+from .sifts import SIFTSIndex
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+import multiprocessing
 import os
+import requests
 
 
 class Fetcher:
@@ -12,35 +30,119 @@ class Fetcher:
 
     """
 
-    def __init__(self, main_db: str = "pdb", save_directory: str = None):
+    def __init__(
+        self,
+        main_db: str = "pdb",
+        save_directory: str = None,
+        session: requests.Session = None,
+        timeout: float = 60,
+        retries: int = 3,
+        negative_ttl: float = 7 * 24 * 3600,
+        id_ttl: float = 30 * 24 * 3600,
+        sifts: str = None,
+        alphafold_accessions: str = None,
+        codec: str = None,
+        max_cache_size: int = None,
+        cache_policy: str = "lru",
+        signal_ttl: float = 30 * 24 * 3600,
+        render: bool = False,
+    ):
         """
         Initialise the fetcher
 
+        All the databases share one HTTP session so that connections are
+        reused between them.
+
+        Args:
+            main_db: The default database (pdb or alphafold)
+            save_directory: The cache directory
+            session: An HTTP session to use instead of our own
+            timeout: The timeout of a request in seconds
+            retries: The number of times to retry a failed request
+            negative_ttl: How long to remember that an id is not available
+                in a database, in seconds
+            id_ttl: How long to remember the PDB ids matching a uniprot id,
+                and the AlphaFold files of one, in seconds
+            sifts: A SIFTS pdb_chain_uniprot TSV file, or an index built
+                from one, to look up PDB ids without searching
+            alphafold_accessions: The AlphaFold accession_ids.csv file, or an
+                index built from one, to look up models without probing
+            codec: Compress the saved files with gzip or zstd
+            max_cache_size: Evict files from the cache to keep it under this
+                many bytes
+            cache_policy: Evict the least recently (lru) or frequently (lfu)
+                used files first
+            signal_ttl: How long to remember the signal peptides of a uniprot
+                id, in seconds
+            render: Render the AlphaFold entry page in a headless browser to
+                find the file URL if the API doesn't give it, this needs the
+                render extra
+
         """
+        if session is None:
+            session = PooledSession(timeout=timeout, retries=retries)
         self.type = main_db
-        self.pdb = PDB_DB()
-        self.alpha = Alphafold_DB()
+        self.session = session
         self.search_results = {}  # type: ignore
         self.save_directory = save_directory
-        self.Cleaver = Cleaver()
+        self.negative_ttl = negative_ttl
+        self.codec = codec
+        self.max_cache_size = max_cache_size
+        self.cache_policy = cache_policy
+        self.id_ttl = id_ttl
+        self.signal_ttl = signal_ttl
+        self.pdb = PDB_DB(
+            session=session,
+            id_cache=self.id_cache(),
+            sifts_index=SIFTSIndex.from_file(sifts) if sifts else None,
+        )
+        self.alpha = Alphafold_DB(
+            session=session,
+            accession_index=AlphafoldIndex.from_file(alphafold_accessions)
+            if alphafold_accessions
+            else None,
+            prediction_cache=self.prediction_cache(),
+            render=render,
+        )
+        self.Cleaver = Cleaver(
+            session=session, signal_cache=self.signal_cache()
+        )
 
-    def check_db(self, uniprot_id: str) -> list:
+    def check_db(self, uniprot_id: str, refresh: bool = False) -> list:
         """
         Checks which database contains the searched ID.
 
+        This only queries the databases and doesn't download any structure.
+        Databases recently found not to have the structure are skipped
+        unless refresh is set.
+
         Args:
             uniprot_id: ID from Uniprot
+            refresh: Ignore what is known about missing structures
 
         Returns:
             The list of the databases where the id is available
 
         """
 
+        # Get the databases known not to have the structure
+        negative_cache = self.negative_cache()
+        if refresh:
+            negative_cache.remove(uniprot_id)
+        missing_db = negative_cache.missing(uniprot_id)
+
         available_db = []
-        if self.pdb.check_structure(uniprot_id):
-            available_db.append("pdb")
-        if self.alpha.check_structure(uniprot_id):
-            available_db.append("alphafold")
+        not_found_db = []
+        for db, database in [("pdb", self.pdb), ("alphafold", self.alpha)]:
+            if db in missing_db:
+                continue
+            if database.check_structure(uniprot_id):
+                available_db.append(db)
+            else:
+                not_found_db.append(db)
+
+        # Remember where the structure was not found
+        negative_cache.add(uniprot_id, not_found_db)
         return available_db
 
     def cache(self) -> PDBFileCache:
@@ -49,13 +151,56 @@ class Fetcher:
             The PDB file cache
 
         """
-        return PDBFileCache(directory=self.save_directory)
+        return PDBFileCache(
+            directory=self.save_directory,
+            codec=self.codec,
+            max_size=self.max_cache_size,
+            policy=self.cache_policy,
+        )
+
+    def negative_cache(self) -> NegativeCache:
+        """
+        Returns:
+            The cache of ids known not to be available in a database
+
+        """
+        return NegativeCache(
+            directory=self.save_directory, ttl=self.negative_ttl
+        )
+
+    def id_cache(self) -> PDBIdCache:
+        """
+        Returns:
+            The cache of PDB ids matching each uniprot id
+
+        """
+        return PDBIdCache(directory=self.save_directory, ttl=self.id_ttl)
+
+    def prediction_cache(self) -> PredictionCache:
+        """
+        Returns:
+            The cache of the AlphaFold model of each uniprot id
+
+        """
+        return PredictionCache(directory=self.save_directory, ttl=self.id_ttl)
+
+    def signal_cache(self) -> SignalPeptideCache:
+        """
+        Returns:
+            The cache of the signal peptides of each uniprot id
+
+        """
+        return SignalPeptideCache(
+            directory=self.save_directory, ttl=self.signal_ttl
+        )
 
     def file_from_db(
         self,
         prot_id: str,
         filetype: str = "cif",
         db: str = "pdb",
+        compressed: bool = False,
+        stream: bool = False,
     ) -> tuple:
         """
         Returns the file from the correspondent database.
@@ -64,13 +209,15 @@ class Fetcher:
             uniprot_id: ID from Uniprot.
             filetype: File type to be retrieved: cif, pdb.
             db: database from which to retrieve the file.
+            compressed: Return the file gzip compressed, as bytes.
+            stream: Return an iterator of the file data as bytes chunks.
 
         Returns:
             Tuple containing the filename and file from the database
 
         """
         return {"pdb": self.pdb.get_pdb, "alphafold": self.alpha.get_pdb}[db](
-            prot_id, filetype=filetype
+            prot_id, filetype=filetype, compressed=compressed, stream=stream
         )
 
     def get_file(
@@ -79,38 +226,72 @@ class Fetcher:
         filetype: str = "cif",
         filesave: bool = False,
         db: str = "pdb",
+        refresh: bool = False,
+        stream: bool = False,
+        clean: bool = False,
     ) -> tuple:
         """
         Returns the file from an available database, starting with the
         default that the user provided.
 
+        With stream set, the download is written into the cache a chunk at a
+        time and a lazy handle on the cached file is returned instead of the
+        file, so the whole file is never held in memory.
+
+        With clean set, the signal peptides, hydrogens, water molecules and
+        HETATM entries are removed from the file in memory once it is
+        fetched, as remove does, but without writing and reading back files.
+        The cache always holds the file as it was downloaded.
+
         Args:
             uniprot_id: ID from Uniprot.
             filetype: File type to be retrieved: cif, pdb.
             filesave: Option to save into a file.
             db: database from which to retrieve the file.
+            refresh: Ignore what is known about missing structures.
+            stream: Stream the file into the cache, implies filesave.
+            clean: Remove the non main parts of the file, either True or a
+                dictionary of the flags to pass to clean_data.
 
         Returns:
             A tuple containing:
             1. File name of the saved file
             2. File from the database, or None if it is not available in any database.
+            Or the CachedFile handle instead of the file if streaming.
 
         """
+        if clean and stream:
+            raise RuntimeError(
+                "Can't clean a streamed file, use remove on the cached file"
+            )
 
         # Get the PDB cache
-        cache = PDBFileCache(directory=self.save_directory)
+        cache = self.cache()
+
+        # If the file is already downloaded then use that, unless another
+        # process removed it since. Structures from the PDB are cached under
+        # the uniprot id and the PDB id
+        found = cache.resolve(uniprot_id, filetype)
+        filename = found[1] if found is not None else None
+        if filename is not None and stream:
+            filedata = cache.handle(found[0], filetype)
+            if filedata is None:
+                filename = None
+        elif filename is not None:
+            try:
+                with open_file(filename) as infile:
+                    filedata = infile.read()
+            except FileNotFoundError:
+                cache.forget(found[0], filetype)
+                filename = None
 
-        # If the file is already downloaded then use that, otherwise search in
-        # the PDB or alphafold databases
-        if (
-            uniprot_id in cache
-            and os.path.splitext(cache[uniprot_id])[1] == filetype
-        ):
-            filename = cache[uniprot_id]
-            with open(filename) as infile:
-                filedata = infile.read()
-        else:
-            self.search_results[uniprot_id] = self.check_db(uniprot_id)
+        # Otherwise search in the PDB or alphafold databases
+        if filename is None:
+            # Keep the downloaded file compressed if the cache is gzipped
+            compressed = (filesave or stream) and cache.codec == "gzip"
+            self.search_results[uniprot_id] = self.check_db(
+                uniprot_id, refresh=refresh
+            )
             if len(self.search_results[uniprot_id]):
                 if db in self.search_results[uniprot_id]:
                     print("Structure available on defaulted database: " + db)
@@ -118,6 +299,8 @@ class Fetcher:
                         prot_id=uniprot_id,
                         filetype=filetype,
                         db=db,
+                        compressed=compressed,
+                        stream=stream,
                     )
                     fileorigin = db
                 else:
@@ -130,23 +313,153 @@ class Fetcher:
                             prot_id=uniprot_id,
                             filetype=filetype,
                             db=item,
+                            compressed=compressed,
+                            stream=stream,
                         )
-                        fileorigin = db
+                        fileorigin = item
             else:
                 raise RuntimeError(
                     "Structure %s not available on any database" % uniprot_id
                 )
 
             # Optionally save the data
-            if filesave:
+            if stream:
+                filedata = cache.write(
+                    identifier,
+                    fileorigin,
+                    filetype,
+                    filedata,
+                    "gzip" if compressed else None,
+                )
+                filename = filedata.filename
+            elif compressed:
+                cache[identifier] = (fileorigin, filetype, filedata, "gzip")
+                filename = cache[identifier]
+                filedata = decompress(filedata, "gzip").decode()
+            elif filesave:
                 cache[identifier] = (fileorigin, filetype, filedata)
                 filename = cache[identifier]
             else:
                 filename = None
 
+        # Optionally clean the file in memory
+        if clean:
+            filedata = self.clean_data(
+                uniprot_id,
+                filedata,
+                filetype,
+                **(clean if isinstance(clean, dict) else {}),
+            )
+
         # Return the filename and file
         return filename, filedata
 
+    def clean_data(
+        self,
+        uniprot_id: str,
+        filedata,
+        filetype: str = "cif",
+        signal_peptides=True,
+        hydrogens=True,
+        water=True,
+        hetatoms=True,
+    ):
+        """
+        Removes signal peptides according to UniProt, hydrogens, water
+        molecules, and HETATM entries from a file in memory.
+
+        Args:
+            uniprot_id: UniProt ID of the structure.
+            filedata: The file as str or bytes.
+            filetype: File type of the file: cif, pdb.
+            signal_peptides: Whether to remove signal peptides (default: True)
+            hydrogens: Whether to remove hydrogens (default: True)
+            water: Whether to remove water molecules (default: True)
+            hetatoms: Whether to remove HETATM entries (default: True)
+
+        Returns:
+            The cleaned file, of the same type as filedata
+
+        """
+        signal_list = (
+            self.Cleaver.signal_residuenumbers_requester(uniprot_id)
+            if signal_peptides
+            else []
+        )
+        return Cleaver.remove_nonmain_data(
+            filedata,
+            filetype,
+            signal_list,
+            signal_peptides,
+            hydrogens,
+            water,
+            hetatoms,
+        )
+
+    def get_files(
+        self,
+        uniprot_ids: list,
+        filetype: str = "cif",
+        filesave: bool = False,
+        db: str = "pdb",
+        max_workers: int = 8,
+        refresh: bool = False,
+        stream: bool = False,
+        clean: bool = False,
+    ) -> tuple:
+        """
+        Returns the files for many ids, fetching them concurrently.
+
+        A failure to fetch one id does not abort the batch; the exception is
+        returned alongside the successful results instead.
+
+        Args:
+            uniprot_ids: IDs from Uniprot.
+            filetype: File type to be retrieved: cif, pdb.
+            filesave: Option to save into a file.
+            db: database from which to retrieve the file.
+            max_workers: The number of ids to fetch in parallel.
+            refresh: Ignore what is known about missing structures.
+            stream: Stream the files into the cache, implies filesave.
+            clean: Remove the non main parts of the files, see get_file.
+
+        Returns:
+            A tuple containing:
+            1. A dictionary of (filename, filedata) tuples keyed by id
+            2. A dictionary of exceptions keyed by the ids that failed
+
+        """
+        # Make sure each worker can keep its connections alive
+        if (
+            isinstance(self.session, PooledSession)
+            and self.session.pool_size < max_workers
+        ):
+            self.session.set_pool_size(max_workers)
+
+        results = {}
+        errors = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    self.get_file,
+                    uniprot_id,
+                    filetype=filetype,
+                    filesave=filesave,
+                    db=db,
+                    refresh=refresh,
+                    stream=stream,
+                    clean=clean,
+                ): uniprot_id
+                for uniprot_id in dict.fromkeys(uniprot_ids)
+            }
+            for future in as_completed(futures):
+                uniprot_id = futures[future]
+                try:
+                    results[uniprot_id] = future.result()
+                except Exception as e:
+                    errors[uniprot_id] = e
+        return results, errors
+
     def search_history(self) -> dict:
         """
         Returns:
@@ -164,6 +477,9 @@ class Fetcher:
 
         """
         self.save_directory = os.path.abspath(os.path.expanduser(new_dir))
+        self.pdb.id_cache = self.id_cache()
+        self.alpha.prediction_cache = self.prediction_cache()
+        self.Cleaver.signal_cache = self.signal_cache()
 
     def get_default_db(self) -> str:
         """
@@ -209,40 +525,176 @@ class Fetcher:
             None
 
         """
-        # Get the PDB cache
-        cache = PDBFileCache(directory=self.save_directory)
-        identifier, _, _ = self.pdb.get_pdb(uniprot_id, filetype="cif")
-        if uniprot_id in cache:
-            filename = cache[uniprot_id]
-            signal_list = self.Cleaver.signal_residuenumbers_requester(
-                uniprot_id
-            )
+        # Find the file in the cache, only UniProt is asked for the signal
+        # peptides
+        try:
+            filename = self.cached_filename(uniprot_id)
+        except RuntimeError:
+            print("Please first download the protein structure using profet.")
+            return
+        signal_list = (
+            self.Cleaver.signal_residuenumbers_requester(uniprot_id)
+            if signal_peptides
+            else []
+        )
 
-            self.Cleaver.remove_nonmain(
-                filename,
-                signal_list,
-                signal_peptides,
-                hydrogens,
-                water,
-                hetatoms,
-                output_filename,
-            )
+        self.Cleaver.remove_nonmain(
+            filename,
+            signal_list,
+            signal_peptides,
+            hydrogens,
+            water,
+            hetatoms,
+            output_filename,
+        )
 
-        # Make sure the file was not annotated by the get_pdb in the case of a ProteinDataBank pull
-        elif identifier in cache:
-            filename = cache[identifier]
-            signal_list = self.Cleaver.signal_residuenumbers_requester(
-                uniprot_id
-            )
-            self.Cleaver.remove_nonmain(
-                filename,
-                signal_list,
-                signal_peptides,
-                hydrogens,
-                water,
-                hetatoms,
-                output_filename,
+    def cached_filename(self, uniprot_id: str) -> str:
+        """
+        Get the cached file of a structure
+
+        The file is found from the cache manifest, without the network.
+
+        Args:
+            uniprot_id: UniProt ID of the structure.
+
+        Returns:
+            The filename
+
+        """
+        found = self.cache().resolve(uniprot_id)
+        if found is None:
+            raise RuntimeError(
+                "Structure %s not in cache, download it first" % uniprot_id
             )
+        return found[1]
+
+    def remove_files(
+        self,
+        uniprot_ids: list,
+        signal_peptides=True,
+        hydrogens=True,
+        water=True,
+        hetatoms=True,
+        max_workers: int = None,
+        max_requests: int = 8,
+    ) -> tuple:
+        """
+        Removes signal peptides, hydrogens, water molecules, and HETATM
+        entries from the cached files of many ids in parallel.
+
+        The files are cleaved on a pool of processes. The signal peptides are
+        requested from UniProt in batches on a pool of threads at the same
+        time, unless they are cached, and each file is cleaved as soon as
+        its signal peptides arrive.
+
+        Args:
+            uniprot_ids: UniProt IDs of the structures.
+            signal_peptides: Whether to remove signal peptides (default: True)
+            hydrogens: Whether to remove hydrogens (default: True)
+            water: Whether to remove water molecules (default: True)
+            hetatoms: Whether to remove HETATM entries (default: True)
+            max_workers: The number of processes, by default the number of
+                CPUs
+            max_requests: The number of UniProt batch requests in parallel
 
+        Returns:
+            A tuple containing:
+            1. A dictionary of the output filenames keyed by id
+            2. A dictionary of exceptions keyed by the ids that failed
+
+        """
+        # Make sure each thread can keep its connections alive
+        if (
+            isinstance(self.session, PooledSession)
+            and self.session.pool_size < max_requests
+        ):
+            self.session.set_pool_size(max_requests)
+
+        def prepare(batch):
+            # Find the files first so that only the signal peptides of the
+            # cached structures are requested
+            prepared = {}
+            for uniprot_id in batch:
+                try:
+                    prepared[uniprot_id] = (
+                        self.cached_filename(uniprot_id),
+                        [],
+                    )
+                except Exception as e:
+                    prepared[uniprot_id] = e
+            found = [i for i in batch if not isinstance(prepared[i], Exception)]
+            if not signal_peptides or not found:
+                return prepared
+
+            try:
+                signals = self.Cleaver.signal_peptides_batch(found)
+            except Exception:
+                # Find out which ids failed one at a time
+                signals = {}
+                requester = self.Cleaver.signal_residuenumbers_requester
+                for uniprot_id in found:
+                    try:
+                        signals[uniprot_id] = requester(uniprot_id)
+                    except Exception as e:
+                        prepared[uniprot_id] = e
+            for uniprot_id, signal_list in signals.items():
+                prepared[uniprot_id] = (prepared[uniprot_id][0], signal_list)
+            return prepared
+
+        # The signal peptides are requested in batches
+        uniprot_ids = list(dict.fromkeys(uniprot_ids))
+        batch_size = self.Cleaver.batch_size
+        batches = [
+            uniprot_ids[i : i + batch_size]
+            for i in range(0, len(uniprot_ids), batch_size)
+        ]
+
+        # Forking while the threads run could copy their held locks
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
         else:
-            print("Please first download the protein structure using profet.")
+            context = multiprocessing.get_context("spawn")
+
+        results = {}
+        errors = {}
+        with ThreadPoolExecutor(max_workers=max_requests) as threads:
+            with ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=context
+            ) as processes:
+                prepared = {
+                    threads.submit(prepare, batch): batch for batch in batches
+                }
+
+                # Cleave the files as they are ready
+                cleaved = {}
+                for future in as_completed(prepared):
+                    try:
+                        items = future.result()
+                    except Exception as e:
+                        items = {
+                            uniprot_id: e for uniprot_id in prepared[future]
+                        }
+                    for uniprot_id, item in items.items():
+                        if isinstance(item, Exception):
+                            errors[uniprot_id] = item
+                            continue
+                        filename, signal_list = item
+                        cleaved[
+                            processes.submit(
+                                Cleaver.remove_nonmain,
+                                filename,
+                                signal_list,
+                                signal_peptides,
+                                hydrogens,
+                                water,
+                                hetatoms,
+                            )
+                        ] = uniprot_id
+
+                for future in as_completed(cleaved):
+                    uniprot_id = cleaved[future]
+                    try:
+                        results[uniprot_id] = future.result()
+                    except Exception as e:
+                        errors[uniprot_id] = e
+        return results, errors
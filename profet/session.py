@@ -0,0 +1,72 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class PooledSession(requests.Session):
+    """
+    A requests session shared by the database backends
+
+    Connections are kept alive in a pool so that repeated requests to the
+    same host don't pay for a new TCP and TLS handshake. Requests that fail
+    with a connection error or a 5xx status are retried with exponential
+    backoff, and every request gets a default timeout.
+
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        timeout: float = 60,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+    ):
+        """
+        Initialise the session
+
+        Args:
+            pool_size: The number of connections to keep alive per host
+            timeout: The default timeout of a request in seconds
+            retries: The number of times to retry a failed request
+            backoff_factor: The backoff factor between retries in seconds
+
+        """
+        super().__init__()
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.set_pool_size(pool_size)
+
+    def set_pool_size(self, pool_size: int):
+        """
+        Set the number of connections to keep alive per host
+
+        This should be at least the number of threads sharing the session,
+        otherwise connections are discarded rather than reused.
+
+        Args:
+            pool_size: The number of connections
+
+        """
+        self.pool_size = pool_size
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        """
+        Perform a request with the default timeout unless one is given
+
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
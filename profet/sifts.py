@@ -0,0 +1,86 @@
+"""A local index of the SIFTS mapping between UniProt and the PDB
+
+The mapping is distributed by EBI as pdb_chain_uniprot.tsv.gz, see
+https://www.ebi.ac.uk/pdbe/docs/sifts/quick.html"""
+
+from .index import SortedIndex
+import gzip
+
+
+class SIFTSIndex(SortedIndex):
+    """
+    A class to look up the PDB ids matching a uniprot id without the network
+
+    The index is built once from the SIFTS pdb_chain_uniprot TSV file into a
+    sorted file of fixed width (uniprot id, pdb id) records.
+
+    """
+
+    # The index file header and the widths of the record fields
+    magic = b"PROFET-SIFTS-1\n"
+    uniprot_width = 10
+    pdb_width = 12
+    key_size = uniprot_width
+    record_size = uniprot_width + pdb_width
+
+    @classmethod
+    def build(cls, source_filename: str, filename: str) -> "SIFTSIndex":
+        """
+        Build the index from a SIFTS pdb_chain_uniprot TSV file
+
+        Args:
+            source_filename: The TSV file, optionally gzipped
+            filename: The index filename to write
+
+        Returns:
+            The index
+
+        """
+
+        def records(infile):
+            for line in infile:
+                # Skip the timestamp comment and the column header
+                if line.startswith("#") or line.startswith("PDB\t"):
+                    continue
+                columns = line.split("\t")
+                if len(columns) < 3:
+                    continue
+                yield (
+                    columns[2].strip().upper().ljust(cls.uniprot_width)
+                    + columns[0].strip().upper().ljust(cls.pdb_width)
+                ).encode("ascii")
+
+        opener = gzip.open if source_filename.endswith(".gz") else open
+        with opener(source_filename, "rt") as infile:
+            cls.write(records(infile), filename)
+        return cls(filename)
+
+    def get(self, uniprot_id: str) -> list:
+        """
+        Get the PDB ids matching the uniprot id
+
+        Args:
+            uniprot_id: The uniprot id
+
+        Returns:
+            The sorted list of PDB ids, empty if there are none
+
+        """
+        key = uniprot_id.upper().ljust(self.uniprot_width).encode("ascii")
+        return [
+            record[self.uniprot_width :].decode("ascii").strip()
+            for record in self.find(key)
+        ]
+
+    def __contains__(self, uniprot_id: str) -> bool:
+        """
+        Check if the uniprot id has any PDB ids
+
+        Args:
+            uniprot_id: The uniprot id
+
+        Returns:
+            True/False if the uniprot id is in the index
+
+        """
+        return len(self.get(uniprot_id)) > 0